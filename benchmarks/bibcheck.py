@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+''' Check that librarianlib.bibparse agrees with bibtexparser. Bibtex entries
+    are generated with the fields of benchmarks/synthetic.py, written in a
+    random mix of the syntax that bibtex allows, and then some are mutated to
+    be unusual or invalid. Each entry must either be parsed by bibparse to
+    exactly the fields that bibtexparser gives, or be left to bibtexparser.
+    Exits with a non-zero status if any entry is parsed differently, and
+    reports the time taken by each parser. '''
+
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import bibtexparser
+
+from librarianlib import bibparse
+
+import synthetic
+
+
+# Values that exercise the parsing of braces, quotes, accents, and lines.
+TRICKY_VALUES = [
+    '{NASA} and the {Moon}',
+    'Schr{\\"o}dinger {\\\'e}t{\\\'e} na\\"ive',
+    'Robust {{Nested {Braces}}} here',
+    'A "quoted" word',
+    'Line one\n     line two\n\tline three',
+    'Trailing space ',
+    '100\\% sure',
+    '{}',
+    '',
+    'Café über',
+    'x@y.com',
+    '#hash',
+]
+
+# Mutations of the text of an entry, most of which bibparse leaves to
+# bibtexparser.
+MUTATIONS = [
+    lambda text, rng: text.replace('{', '(', 1)[:-1] + ')',
+    lambda text, rng: '@string{foo = "Foo"}\n' + text,
+    lambda text, rng: '% comment\n' + text,
+    lambda text, rng: text + '\n' + text.replace('@', '@ ', 1),
+    lambda text, rng: text.replace('@', '@online', 1).replace(
+        text[1:text.index('{')], '', 1),
+    lambda text, rng: text[:-1],
+    lambda text, rng: text.replace('=', '', 1),
+    lambda text, rng: text.replace(',', ' ,', 1),
+    lambda text, rng: text.replace(',', '', 1),
+    lambda text, rng: text.replace('{', '{ ', 1),
+    lambda text, rng: text.replace('@', '@ ', 1),
+    lambda text, rng: '\ufeff' + text,
+    lambda text, rng: text.replace('\n', '\r\n'),
+    lambda text, rng: text.replace('}\n', '} # foo\n', 1),
+    lambda text, rng: text.replace('}\n', '} # 12\n', 1),
+    lambda text, rng: text[:-1] + 'note = 12abc\n}',
+    lambda text, rng: text[:-1] + 'note = 12 # {x}\n}',
+    lambda text, rng: text[:-1] + 'NOTE = {upper}\n}',
+    lambda text, rng: text[:-1] + 'title = {Duplicate}\n}',
+    lambda text, rng: text[:-1] + 'Title = {Duplicate}\n}',
+    lambda text, rng: text[:-1] + 'note = {a}}\n}',
+    lambda text, rng: text[:-1] + 'note = "a}"\n}',
+    lambda text, rng: text[:-1] + 'note = "a{"}"\n}',
+    lambda text, rng: text[:-1] + 'note = {{}} # {}\n}',
+    lambda text, rng: text.replace(text[text.index('{') + 1:text.index(',')],
+                                   'key with space', 1),
+    lambda text, rng: text.replace(text[text.index('{') + 1:text.index(',')],
+                                   'key:with/odd-chars_1', 1),
+    lambda text, rng: text + '\ntrailing text',
+    lambda text, rng: text.replace('author', 'editor', 1),
+]
+
+
+def _delimit(value, rng):
+    ''' Write a value in braces or quotes, or as a concatenation. '''
+    style = rng.random()
+    if style < 0.5 or '"' in value:
+        return '{' + value + '}'
+    if style < 0.8 or '{' in value:
+        return '"' + value + '"'
+    split = rng.randint(0, len(value))
+    return '"{}" # {{{}}}'.format(value[:split], value[split:])
+
+
+def generate_entry(i, rng):
+    ''' Generate the text of a bibtex entry. '''
+    entrytype, venue_field, venue = rng.choice(synthetic.VENUES)
+    title = ' '.join(rng.choice(synthetic.WORDS)
+                     for _ in range(rng.randint(3, 9)))
+    if rng.random() < 0.3:
+        title = rng.choice(TRICKY_VALUES) + ' ' + title
+    authors = ' and '.join(
+        '{}, {}'.format(rng.choice(synthetic.LAST_NAMES),
+                        rng.choice(synthetic.FIRST_NAMES))
+        for _ in range(rng.randint(1, 5)))
+    year = rng.randint(1980, 2024)
+    month = rng.choice(synthetic.MONTHS)
+
+    fields = [
+        ('title', _delimit(title, rng)),
+        ('author', _delimit(authors, rng)),
+        ('year', str(year) if rng.random() < 0.5 else _delimit(str(year), rng)),
+        ('month', month if rng.random() < 0.7
+                  else '{} # "~{}"'.format(month, rng.randint(1, 28))),
+        (venue_field, _delimit(venue, rng)),
+    ]
+    if rng.random() < 0.3:
+        fields.append(('note', _delimit(rng.choice(TRICKY_VALUES), rng)))
+    rng.shuffle(fields)
+
+    key = '{}{}doc{}'.format(rng.choice(synthetic.LAST_NAMES).lower(), year, i)
+    space = rng.choice([' ', '', '  '])
+    lines = ['  {}{}={}{}'.format(name, space, space, value)
+             for name, value in fields]
+    trailing = ',' if rng.random() < 0.3 else ''
+    return '@{}{{{},\n{}{}\n}}'.format(entrytype, key, ',\n'.join(lines),
+                                       trailing)
+
+
+def reference_parse(text):
+    ''' Parse an entry with bibtexparser, as librarianlib did before
+        bibparse. Returns the fields of the entry, or None if bibtexparser
+        finds no entry or fails. '''
+    parser = bibtexparser.bparser.BibTexParser(common_strings=True)
+    try:
+        entries = bibtexparser.loads(text, parser=parser).entries
+    except Exception:
+        return None
+    return entries[0] if entries else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=5000,
+                        help='Number of entries to check.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--mutated', type=float, default=0.2,
+                        help='Fraction of the entries to mutate.')
+    args = parser.parse_args()
+
+    # bibtexparser logs entries it skips.
+    logging.disable(logging.WARNING)
+
+    rng = random.Random(args.seed)
+    texts = []
+    for i in range(args.count):
+        text = generate_entry(i, rng)
+        if rng.random() < args.mutated:
+            text = rng.choice(MUTATIONS)(text, rng)
+        texts.append(text.strip())
+
+    start = time.perf_counter()
+    fast = [bibparse.parse_entry(text) for text in texts]
+    fast_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = [reference_parse(text) for text in texts]
+    reference_time = time.perf_counter() - start
+
+    parsed = 0
+    mismatches = []
+    for text, entry, expected in zip(texts, fast, reference):
+        if entry is None:
+            continue
+        parsed += 1
+        if entry != expected:
+            mismatches.append((text, entry, expected))
+
+    print('{} entries: {} parsed by bibparse, {} left to bibtexparser.'.format(
+        len(texts), parsed, len(texts) - parsed))
+    print('bibparse: {:.1f} us per entry, bibtexparser: {:.1f} us per '
+          'entry.'.format(1e6 * fast_time / len(texts),
+                          1e6 * reference_time / len(texts)))
+    for text, entry, expected in mismatches[:10]:
+        print('\nMismatch for:\n{}\nbibparse:     {}\nbibtexparser: {}'.format(
+            text, entry, expected))
+    if mismatches:
+        print('\n{} mismatches.'.format(len(mismatches)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+''' Time common library operations on synthetic libraries of different sizes
+    and print the results as JSON. Optionally compare the results against a
+    previous run and exit with a non-zero status if any operation has
+    regressed. '''
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from librarianlib.command_interface import LibraryCommandInterface
+from librarianlib.management import LibraryManager
+
+import synthetic
+
+
+CONFIG_FILE_NAME = '.libconf.yaml'
+
+# Searches to time, as keyword arguments to LibraryManager.search_docs.
+SEARCHES = [
+    ('search', {}),
+    ('search --author', {'author': 'smith'}),
+    ('search --title', {'title': 'robot.*control'}),
+    ('search --year', {'year': '2000-2010'}),
+    ('search --type --venue', {'entrytype': 'article', 'venue': 'robotics'}),
+    ('search --tags', {'tags': 'important,learning'}),
+    ('search --author --year --sort', {'author': 'lee', 'year': '2010-2020',
+                                       'sort': 'year'}),
+    ('search --text word', {'text': 'kalman'}),
+    ('search --text regex', {'text': r'kalman\s+filter'}),
+    ('search --text --sort matches', {'text': 'robot', 'sort': 'matches'}),
+    ('search --text --sort relevance', {'text': 'robot', 'sort': 'relevance'}),
+]
+
+
+def _timed(func, repeat):
+    ''' Run a function a number of times, after one warm-up run. Returns a
+        dictionary of summary statistics in seconds. '''
+    func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {'median': statistics.median(times), 'min': min(times)}
+
+
+def _timed_once(func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    return {'median': elapsed, 'min': elapsed}
+
+
+def benchmark_library(path, repeat):
+    ''' Time each of the operations on the library at path. '''
+    def _manager():
+        # A new manager for every run, as for every invocation of lib.
+        return LibraryManager([path], CONFIG_FILE_NAME)
+
+    results = {}
+
+    # Building the indexes from scratch.
+    shutil.rmtree(os.path.join(path, 'library', '.index'), ignore_errors=True)
+    results['catalog (cold)'] = _timed_once(lambda: _manager().catalog())
+    results['text index (cold)'] = _timed_once(
+            lambda: list(_manager().search_docs(text='kalman')))
+
+    for name, kwargs in SEARCHES:
+        results[name] = _timed(
+                lambda: list(_manager().search_docs(**kwargs)), repeat)
+
+    # Regex searches again, using the corpus file.
+    _manager().build_corpus()
+    for name, kwargs in SEARCHES:
+        if 'text' in kwargs and name.endswith('regex'):
+            results[name + ' (corpus)'] = _timed(
+                    lambda: list(_manager().search_docs(**kwargs)), repeat)
+
+    results['tags'] = _timed(lambda: _manager().get_tags(), repeat)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        def _compile_bib():
+            cmd_interface = LibraryCommandInterface(_manager())
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    cmd_interface.compile(bib=True, text=False,
+                                          output='bibtex.bib', force=True)
+            finally:
+                os.chdir(cwd)
+        results['compile --bib'] = _timed(_compile_bib, repeat)
+
+    key = sorted(_manager().all_keys())[0]
+
+    def _rekey():
+        manager = _manager()
+        manager.rekey(key, key + 'renamed')
+        manager.rekey(key + 'renamed', key)
+    results['rekey'] = _timed(_rekey, repeat)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        rng = random.Random(0)
+        staging = []
+        for i in range(repeat + 1):
+            staging.append(synthetic.generate_document(
+                    tmp, 'benchmarkadd{}'.format(i), rng))
+        added = []
+
+        def _add():
+            pdf_path, bib_path = staging[len(added)]
+            added.append(_manager().add(pdf_path, bib_path).key)
+        results['add'] = _timed(_add, repeat)
+
+        for key in added:
+            shutil.rmtree(os.path.join(path, 'library', 'archive', key))
+
+    return results
+
+
+def _prepare_library(workdir, size):
+    ''' Generate the library of the given size, unless it already exists from
+        a previous run. Returns the directory containing its config file. '''
+    path = os.path.join(workdir, 'library-{}'.format(size))
+    library_path = os.path.join(path, 'library')
+    if not os.path.exists(library_path):
+        synthetic.generate_library(library_path, size)
+        with open(os.path.join(path, CONFIG_FILE_NAME), 'w') as f:
+            f.write('library: {}\n'.format(library_path))
+    return path
+
+
+def _regressions(results, baseline, tolerance):
+    ''' List the operations that are slower than in the baseline by more than
+        the tolerance factor. '''
+    regressions = []
+    for size, ops in results.items():
+        for op, stats in ops.items():
+            try:
+                old = baseline[size][op]['median']
+            except KeyError:
+                continue
+            if stats['median'] > old * tolerance:
+                regressions.append('{} ({} docs): {:.3f}s -> {:.3f}s'.format(
+                    op, size, old, stats['median']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1000],
+                        help='Numbers of documents in the libraries.')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Number of timed runs of each operation.')
+    parser.add_argument('-w', '--workdir',
+                        help='Directory in which to keep the generated '
+                             'libraries between runs. Defaults to a '
+                             'temporary directory.')
+    parser.add_argument('-o', '--output', help='Write results to a file.')
+    parser.add_argument('-c', '--compare',
+                        help='Results of a previous run to compare against.')
+    parser.add_argument('-t', '--tolerance', type=float, default=1.25,
+                        help='Factor by which an operation may be slower than '
+                             'in the compared run.')
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        workdir = args.workdir
+        if workdir is None:
+            workdir = stack.enter_context(tempfile.TemporaryDirectory())
+
+        results = {}
+        for size in args.sizes:
+            path = _prepare_library(workdir, size)
+            results[str(size)] = benchmark_library(path, args.repeat)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = _regressions(results, baseline, args.tolerance)
+        if regressions:
+            print('Regressions:\n' + '\n'.join(regressions), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
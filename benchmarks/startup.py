@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+''' Measure the wall time of lib subcommands, each run in a fresh process.
+    Exits with a non-zero status if the median time of `lib where` or
+    `lib complete` is over budget. '''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+LIBRARIAN = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'librarian.py')
+
+# Commands to time, and whether they are subject to the budget. These are the
+# commands run by the zsh completion on every tab press, so they need to feel
+# instant.
+COMMANDS = [
+    (['where'], True),
+    (['complete'], True),
+    (['tags'], False),
+    (['browse'], False),
+]
+
+DEFAULT_BUDGET = 0.15
+
+
+def time_command(argv, cwd, env, runs):
+    ''' Time a number of runs of a lib command. Returns a list of times in
+        seconds. '''
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, LIBRARIAN] + argv, cwd=cwd, env=env,
+                       stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-l', '--library',
+                        help='Library to run against. Defaults to an empty '
+                             'temporary library.')
+    parser.add_argument('-n', '--runs', type=int, default=10,
+                        help='Number of runs of each command.')
+    parser.add_argument('-b', '--budget', type=float, default=DEFAULT_BUDGET,
+                        help='Budget in seconds for where and complete.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print results as JSON.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        library = args.library
+        if library is None:
+            library = os.path.join(tmp, 'library')
+            os.makedirs(os.path.join(library, 'archive'))
+        with open(os.path.join(tmp, '.libconf.yaml'), 'w') as f:
+            f.write('library: {}\n'.format(os.path.abspath(library)))
+
+        # Make sure that a running server doesn't handle the commands.
+        env = dict(os.environ, XDG_RUNTIME_DIR=tmp)
+
+        results = []
+        for argv, budgeted in COMMANDS:
+            times = time_command(argv, tmp, env, args.runs)
+            median = statistics.median(times)
+            results.append({
+                'command': ' '.join(argv),
+                'median': median,
+                'min': min(times),
+                'max': max(times),
+                'budget': args.budget if budgeted else None,
+                'ok': not budgeted or median <= args.budget,
+            })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        tmpl = '{:<10} {:>8} {:>8} {:>8} {:>8}'
+        print(tmpl.format('command', 'median', 'min', 'max', 'budget'))
+        for result in results:
+            budget = result['budget']
+            print(tmpl.format(
+                result['command'], '{:.3f}'.format(result['median']),
+                '{:.3f}'.format(result['min']), '{:.3f}'.format(result['max']),
+                '{:.3f}'.format(budget) if budget is not None else '-'))
+
+    failures = [result['command'] for result in results if not result['ok']]
+    if failures:
+        print('Over budget: {}'.format(', '.join(failures)), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
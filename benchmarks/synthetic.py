@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+''' Generate a synthetic library for benchmarking. Every document has a valid
+    bibtex file, a small PDF, tags, dates, and pre-extracted text (so that no
+    text extraction is needed). '''
+
+import argparse
+import datetime
+import hashlib
+import os
+import random
+
+
+WORDS = '''
+    learning robot control optimal model predictive reinforcement policy
+    gradient network neural deep vision transformer attention graph motion
+    planning trajectory estimation kalman filter state dynamics contact
+    manipulation grasping locomotion legged aerial vehicle autonomous safe
+    robust adaptive nonlinear convex optimization stochastic bayesian
+    inference sampling monte carlo simulation real time embedded sensor
+    fusion localization mapping semantic segmentation detection tracking
+    language reasoning memory representation feature kernel sparse dense
+'''.split()
+
+FIRST_NAMES = '''
+    Alice Bob Carol David Erin Frank Grace Heidi Ivan Judy Mallory Niaj
+    Olivia Peggy Rupert Sybil Trent Victor Walter Yuki Zhang Wei Priya Omar
+'''.split()
+
+LAST_NAMES = '''
+    Smith Jones Lee Brown Garcia Miller Davis Wilson Moore Taylor Anderson
+    Thomas Jackson White Harris Martin Thompson Young King Wright Lopez Hill
+'''.split()
+
+VENUES = [
+    ('inproceedings', 'booktitle', 'IEEE International Conference on Robotics '
+                                   'and Automation'),
+    ('inproceedings', 'booktitle', 'Conference on Robot Learning'),
+    ('inproceedings', 'booktitle', 'Neural Information Processing Systems'),
+    ('article', 'journal', 'IEEE Transactions on Robotics'),
+    ('article', 'journal', 'The International Journal of Robotics Research'),
+    ('book', 'publisher', 'MIT Press'),
+]
+
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep',
+          'oct', 'nov', 'dec']
+
+TAGS = ['to-read', 'read', 'important', 'control', 'learning', 'vision',
+        'planning', 'thesis', 'survey', 'classic']
+
+TEXT_WORDS = 200
+
+
+def _pdf(text):
+    ''' Generate a minimal single-page PDF displaying some text. '''
+    stream = 'BT /F1 12 Tf 72 720 Td ({}) Tj ET'.format(text).encode('ascii')
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+        b'/Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>',
+        b'<< /Length ' + str(len(stream)).encode('ascii') + b' >>\nstream\n'
+        + stream + b'\nendstream',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(pdf))
+        pdf += '{} 0 obj\n'.format(i + 1).encode('ascii') + obj + b'\nendobj\n'
+
+    xref = len(pdf)
+    pdf += 'xref\n0 {}\n0000000000 65535 f \n'.format(
+        len(objects) + 1).encode('ascii')
+    for offset in offsets:
+        pdf += '{:010} 00000 n \n'.format(offset).encode('ascii')
+    pdf += 'trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n'.format(
+        len(objects) + 1, xref).encode('ascii')
+    return pdf
+
+
+def generate_document(archive_path, key, rng):
+    ''' Generate a single document in the archive. Returns the paths of its
+        PDF and bibtex files. '''
+    entrytype, venue_field, venue = rng.choice(VENUES)
+    title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 9)))
+    title = title[0].upper() + title[1:]
+    authors = ' and '.join(
+        '{}, {}'.format(rng.choice(LAST_NAMES), rng.choice(FIRST_NAMES))
+        for _ in range(rng.randint(1, 5)))
+    year = rng.randint(1980, 2024)
+    text = ' '.join(rng.choice(WORDS) for _ in range(TEXT_WORDS))
+
+    key_path = os.path.join(archive_path, key)
+    metadata_path = os.path.join(key_path, '.metadata')
+    os.makedirs(metadata_path)
+
+    bib_path = os.path.join(key_path, key + '.bib')
+    with open(bib_path, 'w') as f:
+        f.write('@{}{{{},\n'
+                '  title = {{{}}},\n'
+                '  author = {{{}}},\n'
+                '  year = {{{}}},\n'
+                '  month = {},\n'
+                '  {} = {{{}}}\n'
+                '}}\n'.format(entrytype, key, title, authors, year,
+                              rng.choice(MONTHS), venue_field, venue))
+
+    pdf_path = os.path.join(key_path, key + '.pdf')
+    pdf = _pdf(title)
+    with open(pdf_path, 'wb') as f:
+        f.write(pdf)
+
+    tags = rng.sample(TAGS, rng.randint(0, 3))
+    if tags:
+        with open(os.path.join(key_path, 'tags.txt'), 'w') as f:
+            f.write('\n'.join(tags))
+
+    # Pre-extracted text, with the hash and signature of the PDF so that it
+    # is considered current.
+    stat = os.stat(pdf_path)
+    with open(os.path.join(metadata_path, 'text.txt'), 'w') as f:
+        f.write(text)
+    with open(os.path.join(metadata_path, 'hash.md5'), 'w') as f:
+        f.write(hashlib.md5(pdf).hexdigest())
+    with open(os.path.join(metadata_path, 'stat.txt'), 'w') as f:
+        f.write('{} {} {}'.format(stat.st_size, stat.st_mtime_ns, stat.st_ino))
+
+    added = datetime.date(2015, 1, 1) + datetime.timedelta(rng.randint(0, 3000))
+    accessed = added + datetime.timedelta(rng.randint(0, 300))
+    with open(os.path.join(metadata_path, 'added.txt'), 'w') as f:
+        f.write(added.isoformat())
+    with open(os.path.join(metadata_path, 'accessed.txt'), 'w') as f:
+        f.write(accessed.isoformat())
+
+    return pdf_path, bib_path
+
+
+def generate_library(path, size, seed=0):
+    ''' Generate a library with the given number of documents. '''
+    rng = random.Random(seed)
+    archive_path = os.path.join(path, 'archive')
+    os.makedirs(archive_path)
+    for i in range(size):
+        key = '{}{}doc{}'.format(rng.choice(LAST_NAMES).lower(),
+                                 rng.randint(1980, 2024), i)
+        generate_document(archive_path, key, rng)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('path', help='Directory in which to create the library.')
+    parser.add_argument('size', type=int, help='Number of documents.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    args = parser.parse_args()
+    generate_library(args.path, args.size, args.seed)
+
+
+if __name__ == '__main__':
+    main()
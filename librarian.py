@@ -2,10 +2,10 @@
 
 import argparse
 import os
+import signal
 import sys
 
-from librarianlib.management import LibraryManager
-from librarianlib.command_interface import LibraryCommandInterface
+from librarianlib import client, profiling
 from librarianlib.exceptions import LibraryException
 
 
@@ -14,8 +14,45 @@ CONFIG_SEARCH_DIRS = [os.path.dirname(os.path.realpath(__file__)), os.getcwd(),
                       os.path.expanduser('~')]
 
 
-def parse_args(cmd_interface):
+def serve(cmd_interface):
+    ''' Run the library server, which runs commands on behalf of clients. '''
+    from librarianlib.management import find_config
+    from librarianlib.server import LibraryServer
+
+    def _handle(argv, cwd):
+        # Only serve clients that would find the same library.
+        search_dirs = [CONFIG_SEARCH_DIRS[0], cwd, CONFIG_SEARCH_DIRS[2]]
+        config_file_path = find_config(search_dirs, CONFIG_FILE_NAME)
+        if config_file_path != cmd_interface.manager.config_file_path:
+            return None
+        os.chdir(cwd)
+        return run(cmd_interface, argv)
+
+    # Clean up the socket when killed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    lib_server = LibraryServer(_handle)
+    print('Serving {} at {}.'.format(cmd_interface.manager.path,
+                                     lib_server.server_address))
+    try:
+        lib_server.serve_forever()
+    finally:
+        lib_server.server_close()
+
+
+def parse_args(cmd_interface, argv=None):
     parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', action='store_true',
+                        help='Print the time spent in each phase of the '
+                             'command. Also enabled by setting LIB_PROFILE.')
+    parser.add_argument('--profile-stats', metavar='FILE',
+                        help='Profile the command and dump cProfile stats to '
+                             'a file. Also enabled by setting LIB_PROFILE to '
+                             'the file name.')
+    parser.add_argument('--read-only', action='store_true',
+                        help='Write nothing to the library, and refuse '
+                             'commands that would, including repair. Also '
+                             'enabled by the read_only setting.')
     subparsers = parser.add_subparsers(help='Command.')
 
     # Link parser.
@@ -43,7 +80,7 @@ def parse_args(cmd_interface):
 
     browse_parser.add_argument('-s', '--sort',
                                choices=['key', 'title', 'year', 'added',
-                                        'recent', 'matches'],
+                                        'recent', 'matches', 'relevance'],
                                help='Sort the results.')
     browse_parser.add_argument('-n', '--number', type=int,
                                help='Limit the number of results.')
@@ -51,14 +88,37 @@ def parse_args(cmd_interface):
                                help='Specify verbosity.')
     browse_parser.add_argument('-r', '--reverse', action='store_true',
                                help='Reverse sorting order.')
+    browse_parser.add_argument('--verify', action='store_true',
+                               help='Rehash PDFs to check their cached text.')
+    browse_parser.add_argument('--explain', action='store_true',
+                               help='Show the order in which the filters are '
+                                    'evaluated and how many documents each '
+                                    'eliminates, instead of the results.')
     browse_parser.set_defaults(func=cmd_interface.browse)
 
     # Add parser.
     add_parser = subparsers.add_parser(
             'add',
             help='Add a new document to the library.')
-    add_parser.add_argument('pdf', help='PDF file.')
-    add_parser.add_argument('bibtex', help='Associated bibtex file.')
+    add_parser.add_argument('pdf', nargs='?', help='PDF file.')
+    add_parser.add_argument('bibtex', nargs='?', help='Associated bibtex file.')
+    add_parser.add_argument('--batch', metavar='DIR',
+                            help='Add every PDF in a directory along with the '
+                                 'bibtex file of the same name.')
+    add_parser.add_argument('--manifest', metavar='FILE',
+                            help='Add the PDF and bibtex file pairs listed in a '
+                                 'file, one pair per line.')
+    add_parser.add_argument('-j', '--jobs', type=int,
+                            help='Number of parallel jobs for batch adds.')
+    add_parser.add_argument('--allow-duplicate', action='store_true',
+                            help='Add the PDF even if it is already in the '
+                                 'archive under another key.')
+    add_parser.add_argument('-x', '--extract', action='store_true',
+                            help='Extract the text of documents added in a '
+                                 'batch.')
+    add_parser.add_argument('--timeout', type=int, default=120,
+                            help='Seconds to spend extracting the text of '
+                                 'each document.')
     add_parser.add_argument('-d', '--delete', action='store_true',
                             help='Delete files after archiving.')
     add_parser.add_argument('-t', '--tag', nargs='+',
@@ -81,8 +141,34 @@ def parse_args(cmd_interface):
                                 help='Compile bibtex files.')
     compile_parser.add_argument('-t', '--text', action='store_true',
                                 help='Compile PDF documents.')
+    compile_parser.add_argument('-o', '--output', default='bibtex.bib',
+                                help='Name of the compiled bibtex file.')
+    compile_parser.add_argument('-f', '--force', action='store_true',
+                                help='Recompile even if nothing has changed.')
+    compile_parser.add_argument('-l', '--link',
+                                choices=['hard', 'sym', 'reflink'],
+                                help='Link or clone PDFs instead of copying.')
+    compile_parser.add_argument('-j', '--jobs', type=int,
+                                help='Number of threads for compiling PDFs.')
     compile_parser.set_defaults(func=cmd_interface.compile)
 
+    # Extract subcommand.
+    extract_parser = subparsers.add_parser(
+            'extract', aliases=['warm'],
+            help='Extract the text of documents for searching.')
+    extract_parser.add_argument('-k', '--key', '--keys', nargs='+',
+                                help='Only extract these documents.')
+    extract_parser.add_argument('-j', '--jobs', type=int,
+                                help='Number of worker processes.')
+    extract_parser.add_argument('--timeout', type=int, default=120,
+                                help='Seconds to spend on each document.')
+    extract_parser.add_argument('--verify', action='store_true',
+                                help='Rehash PDFs even if they appear unchanged.')
+    extract_parser.add_argument('--corpus', action='store_true',
+                                help='Rebuild the corpus file used to speed up '
+                                     'regex text searches.')
+    extract_parser.set_defaults(func=cmd_interface.extract)
+
     # Where subcommand.
     where_parser = subparsers.add_parser('where',
                                          help='Print library archive directory.')
@@ -119,31 +205,81 @@ def parse_args(cmd_interface):
     tags_parser.add_argument('--rename', nargs=2, help='Rename a key.')
     tags_parser.set_defaults(func=cmd_interface.list_tags)
 
+    # compress subcommand.
+    compress_parser = subparsers.add_parser(
+            'compress',
+            help='Convert the cached text of documents to a compression '
+                 'format.')
+    compress_parser.add_argument('-f', '--format',
+                                 choices=['none', 'gzip', 'lzma', 'zstd'],
+                                 help='Compression format. Defaults to the '
+                                      'text_compression setting.')
+    compress_parser.add_argument('-j', '--jobs', type=int,
+                                 help='Number of parallel jobs.')
+    compress_parser.set_defaults(func=cmd_interface.compress)
+
+    # watch subcommand.
+    watch_parser = subparsers.add_parser(
+            'watch',
+            help='Keep the indexes up to date as documents change.')
+    watch_parser.add_argument('--delay', type=float, default=1.0,
+                              help='Seconds to wait for a burst of changes '
+                                   'to end before updating.')
+    watch_parser.add_argument('--no-extract', action='store_true',
+                              help="Don't extract the text of changed PDFs.")
+    watch_parser.add_argument('--timeout', type=int, default=120,
+                              help='Seconds after which to give up on '
+                                   'extracting the text of a document.')
+    watch_parser.set_defaults(func=cmd_interface.watch)
+
+    # dupes subcommand.
+    dupes_parser = subparsers.add_parser(
+            'dupes', help='List documents with identical PDFs.')
+    dupes_parser.set_defaults(func=cmd_interface.dupes)
+
+    # repair subcommand.
+    repair_parser = subparsers.add_parser(
+            'repair',
+            help='Write the metadata that read-only mode leaves missing and '
+                 'update the indexes.')
+    repair_parser.set_defaults(func=cmd_interface.repair)
+
+    # serve subcommand.
+    serve_parser = subparsers.add_parser(
+            'serve', help='Keep the library loaded to speed up commands.')
+    serve_parser.set_defaults(func=lambda **kwargs: serve(cmd_interface))
+
     # Hidden subcommand for generating completion list of keys.
     complete_parser = subparsers.add_parser('complete', help=argparse.SUPPRESS)
     complete_parser.set_defaults(func=cmd_interface.complete)
 
     # Every subparser has an associated function, that we extract here.
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     args = vars(args)
     func = args.pop('func')
     return args, func
 
 
-def main():
-    if len(sys.argv) <= 1:
-        print('Usage: lib command [opts] [args]. Try --help.')
-        return 1
+def run(cmd_interface, argv):
+    ''' Run a single command. Returns the exit status. '''
+    args, func = parse_args(cmd_interface, argv)
 
-    # Load the library manager and command interface.
-    try:
-        manager = LibraryManager(CONFIG_SEARCH_DIRS, CONFIG_FILE_NAME)
-        cmd_interface = LibraryCommandInterface(manager)
-    except LibraryException as e:
-        print(e.message)
-        return 1
+    profile = args.pop('profile')
+    stats_path = args.pop('profile_stats')
+    env_profile, env_stats_path = profiling.env_setting()
+    if env_profile:
+        profile = True
+        if stats_path is None:
+            stats_path = env_stats_path
+    if profile or stats_path:
+        func = profiling.profiled(func, stats_path)
 
-    args, func = parse_args(cmd_interface)
+    # The server runs many commands with the same manager, so the mode is
+    # set for each.
+    manager = cmd_interface.manager
+    read_only = args.pop('read_only')
+    manager.set_read_only(read_only or manager.config_read_only,
+                          explicit=read_only)
 
     try:
         # Handle ctrl-c nicely.
@@ -157,6 +293,30 @@ def main():
     return 0
 
 
+def main():
+    if len(sys.argv) <= 1:
+        print('Usage: lib command [opts] [args]. Try --help.')
+        return 1
+
+    # Hand the command off to the server, if there is one.
+    ret = client.forward(sys.argv[1:])
+    if ret is not None:
+        return ret
+
+    from librarianlib.management import LibraryManager
+    from librarianlib.command_interface import LibraryCommandInterface
+
+    # Load the library manager and command interface.
+    try:
+        manager = LibraryManager(CONFIG_SEARCH_DIRS, CONFIG_FILE_NAME)
+        cmd_interface = LibraryCommandInterface(manager)
+    except LibraryException as e:
+        print(e.message)
+        return 1
+
+    return run(cmd_interface, sys.argv[1:])
+
+
 if __name__ == '__main__':
     ret = main()
     exit(ret)
@@ -0,0 +1,184 @@
+# Parser for the single entry in a document's bibtex file. It accepts the
+# subset of bibtex that such files are written in: one entry delimited by
+# braces, with braced, quoted, or integer values, # concatenations, and the
+# month abbreviations as strings. For those, it produces the same fields as
+# bibtexparser (with common_strings, before any customization) in a fraction of
+# the time. Anything else, e.g. @string definitions, comments, several
+# entries, or syntax errors, is left to bibtexparser: parse_entry returns None.
+
+import re
+
+
+# Entry types that bibtexparser keeps. Entries of any other type are dropped,
+# which is left to bibtexparser to do.
+STANDARD_TYPES = {
+    'article', 'book', 'booklet', 'conference', 'inbook', 'incollection',
+    'inproceedings', 'manual', 'mastersthesis', 'misc', 'phdthesis',
+    'proceedings', 'techreport', 'unpublished',
+}
+
+# Strings defined by bibtexparser's common_strings option.
+COMMON_STRINGS = {
+    'jan': 'January', 'feb': 'February', 'mar': 'March', 'apr': 'April',
+    'may': 'May', 'jun': 'June', 'jul': 'July', 'aug': 'August',
+    'sep': 'September', 'oct': 'October', 'nov': 'November',
+    'dec': 'December',
+}
+
+# Whitespace is only what bibtexparser's grammar (pyparsing) skips.
+_SPACE = re.compile(r'[ \t\n\r]*')
+
+# The entry type and key. Keys with characters that are unusual in a key are
+# left to bibtexparser.
+_START = re.compile(r'@[ \t\n\r]*([A-Za-z]+)[ \t\n\r]*\{[ \t\n\r]*'
+                    r'([^ \t\n\r,{}()"#=@]+)[ \t\n\r]*,')
+
+_FIELD_NAME = re.compile(r'([A-Za-z0-9_\-().+]+)[ \t\n\r]*=[ \t\n\r]*')
+_INTEGER = re.compile(r'[0-9]+')
+_STRING_NAME = re.compile(r'[A-Za-z0-9_\-:]+')
+
+
+def _strip_after_new_lines(s):
+    ''' Strip the leading whitespace of all but the first line, as
+        bibtexparser does to each string in a value. '''
+    lines = s.splitlines()
+    if len(lines) > 1:
+        lines = [lines[0]] + [line.lstrip() for line in lines[1:]]
+    return '\n'.join(lines)
+
+
+def _braced_end(text, pos):
+    ''' Position of the brace closing the one at pos, or None if it isn't
+        closed. '''
+    depth = 0
+    for i in range(pos, len(text)):
+        c = text[i]
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return i
+    return None
+
+
+def _quoted_end(text, pos):
+    ''' Position of the quote closing the one at pos, or None if it isn't
+        closed. Quotes within braces don't close it, and braces must be
+        balanced. '''
+    depth = 0
+    for i in range(pos + 1, len(text)):
+        c = text[i]
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth < 0:
+                return None
+        elif c == '"' and depth == 0:
+            return i
+    return None
+
+
+def _value(text, pos):
+    ''' Parse the value of a field at pos. Returns a tuple (value, pos) of the
+        value as bibtexparser would clean it and the position following it and
+        any whitespace, or None if it can't be parsed. '''
+    match = _INTEGER.match(text, pos)
+    if match:
+        return match.group(), _SPACE.match(text, match.end()).end()
+
+    # A sequence of strings and string names, joined by #.
+    parts = []
+    expression = False
+    while True:
+        c = text[pos:pos+1]
+        if c == '{':
+            end = _braced_end(text, pos)
+            if end is None:
+                return None
+            parts.append(_strip_after_new_lines(text[pos+1:end]))
+            pos = end + 1
+        elif c == '"':
+            end = _quoted_end(text, pos)
+            if end is None:
+                return None
+            parts.append(_strip_after_new_lines(text[pos+1:end]))
+            pos = end + 1
+        else:
+            match = _STRING_NAME.match(text, pos)
+            if not match:
+                return None
+            value = COMMON_STRINGS.get(match.group().lower())
+            if value is None:
+                return None
+            parts.append(value)
+            expression = True
+            pos = match.end()
+
+        pos = _SPACE.match(text, pos).end()
+        if not text.startswith('#', pos):
+            break
+        expression = True
+        pos = _SPACE.match(text, pos + 1).end()
+
+    value = ''.join(parts)
+    # bibtexparser empties a single string that is empty braces, but not an
+    # expression that evaluates to them.
+    if not expression and value == '{}':
+        value = ''
+    return value, pos
+
+
+def parse_entry(text):
+    ''' Parse the text of a bibtex file holding a single entry. Returns a
+        dictionary of its fields, with lower case names, along with its 'ID'
+        and 'ENTRYTYPE', or None if the entry should be parsed by
+        bibtexparser. '''
+    if text.startswith('\ufeff'):
+        text = text[1:]
+    text = text.strip()
+
+    match = _START.match(text)
+    if not match:
+        return None
+    entrytype = match.group(1).lower()
+    if entrytype not in STANDARD_TYPES:
+        return None
+    key = match.group(2)
+
+    fields = []
+    pos = _SPACE.match(text, match.end()).end()
+    while True:
+        match = _FIELD_NAME.match(text, pos)
+        if not match:
+            return None
+        result = _value(text, match.end())
+        if result is None:
+            return None
+        value, pos = result
+        fields.append((match.group(1), value))
+
+        # Fields are separated by commas, and the last may be followed by
+        # one.
+        if text.startswith(',', pos):
+            pos = _SPACE.match(text, pos + 1).end()
+            if text.startswith('}', pos):
+                break
+        elif text.startswith('}', pos):
+            break
+        else:
+            return None
+
+    # Nothing may follow the entry.
+    if pos + 1 != len(text):
+        return None
+
+    # The first of any duplicate fields is kept, as by bibtexparser.
+    fields = {name: value for name, value in reversed(fields)}
+    entry = {}
+    for name, value in fields.items():
+        entry[name.lower()] = value
+    entry['ENTRYTYPE'] = entrytype
+    entry['ID'] = key
+    return entry
@@ -0,0 +1,351 @@
+import datetime
+import os
+import sqlite3
+
+from . import fileutils, profiling
+from .document import DocumentPaths, ArchivalDocument
+
+
+CATALOG_FILE_NAME = 'catalog.db'
+
+# Bump this whenever the schema changes. An out-of-date catalog is simply
+# dropped and rebuilt from the archive.
+CATALOG_VERSION = 3
+
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS docs (
+    key TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    authors TEXT NOT NULL,
+    year TEXT NOT NULL,
+    venue TEXT,
+    entrytype TEXT NOT NULL,
+    added TEXT,
+    accessed TEXT,
+    bib_mtime INTEGER NOT NULL,
+    tag_mtime INTEGER NOT NULL,
+    accessed_mtime INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (tag, key)
+);
+CREATE INDEX IF NOT EXISTS tags_by_key ON tags (key);
+CREATE TABLE IF NOT EXISTS hashes (
+    key TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    hash_mtime INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hashes_by_hash ON hashes (hash);
+CREATE INDEX IF NOT EXISTS docs_by_year ON docs (year);
+CREATE TABLE IF NOT EXISTS tag_counts (
+    tag TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS tag_added AFTER INSERT ON tags
+BEGIN
+    INSERT INTO tag_counts VALUES (NEW.tag, 1)
+        ON CONFLICT (tag) DO UPDATE SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS tag_removed AFTER DELETE ON tags
+BEGIN
+    UPDATE tag_counts SET count = count - 1 WHERE tag = OLD.tag;
+    DELETE FROM tag_counts WHERE tag = OLD.tag AND count <= 0;
+END;
+'''
+
+DATE_FORMAT = '%Y-%m-%d'
+
+# Authors are stored as a single string, separated by newlines.
+AUTHOR_SEPARATOR = '\n'
+
+
+def _mtime(path):
+    ''' Modification time of a file in nanoseconds, or 0 if it does not
+        exist. '''
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def _signature(paths):
+    ''' The modification times used to determine if a catalog entry is
+        stale. '''
+    return (_mtime(paths.bib_path), _mtime(paths.tag_path),
+            _mtime(paths.accessed_path))
+
+
+def _format_date(date):
+    if date is None:
+        return None
+    return date.strftime(DATE_FORMAT)
+
+
+def _parse_date(date):
+    if date is None:
+        return None
+    return datetime.datetime.strptime(date, DATE_FORMAT)
+
+
+class CatalogDocument(ArchivalDocument):
+    ''' A document whose metadata was loaded from the catalog rather than by
+        parsing the files in the archive. '''
+    def __init__(self, key, paths, row, tags):
+        super().__init__(key, paths)
+
+        self._info = (row['title'], row['authors'].split(AUTHOR_SEPARATOR),
+                      row['year'], row['venue'], row['entrytype'])
+        self._tags = tags
+        self._added_date = _parse_date(row['added'])
+        self._accessed_date = _parse_date(row['accessed'])
+
+
+class LibraryCatalog(object):
+    ''' Persistent database of document metadata, stored in the library's
+        index directory. Entries are refreshed whenever the bibtex, tag, or
+        access date files of a document change. The catalog also maps the
+        hashes of the PDFs, as stored in their metadata, to keys.
+
+        In read-only mode, the catalog is copied into memory and refreshed
+        there, so that the copy on disk is never written. '''
+    def __init__(self, index_path, archive_path, read_only=False):
+        self.archive_path = archive_path
+        self.path = os.path.join(index_path, CATALOG_FILE_NAME)
+
+        if read_only:
+            self.conn = sqlite3.connect(':memory:')
+            disk = fileutils.connect_read_only(self.path)
+            if disk is not None:
+                try:
+                    with profiling.phase('catalog copy'):
+                        disk.backup(self.conn)
+                except sqlite3.Error:
+                    # Start from an empty catalog, which is rebuilt from the
+                    # archive.
+                    self.conn.close()
+                    self.conn = sqlite3.connect(':memory:')
+                finally:
+                    disk.close()
+        else:
+            if not os.path.exists(index_path):
+                os.mkdir(index_path)
+            self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        self._init_schema()
+
+        self._columns = None
+        self._columns_version = None
+
+    def _init_schema(self):
+        ''' Create the tables, discarding an incompatible catalog. '''
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != CATALOG_VERSION:
+            tables = self.conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table'")
+            for (table,) in tables.fetchall():
+                self.conn.execute('DROP TABLE {}'.format(table))
+            self.conn.execute('PRAGMA user_version = {}'.format(CATALOG_VERSION))
+        self.conn.executescript(CATALOG_SCHEMA)
+        self.conn.commit()
+
+    def _update(self, key):
+        ''' Parse a document from the archive and store it in the catalog. '''
+        paths = DocumentPaths(self.archive_path, key)
+        doc = ArchivalDocument(key, paths)
+        row = (key, doc.title, AUTHOR_SEPARATOR.join(doc.authors), doc.year,
+               doc.venue, doc.entrytype, _format_date(doc.added_date),
+               _format_date(doc.accessed_date))
+        tags = [(tag, key) for tag in doc.tags]
+
+        # Reading the dates of the document may have written its date files,
+        # so the signature is taken after the row is built.
+        signature = _signature(paths)
+
+        self._columns = None
+        self.conn.execute('DELETE FROM tags WHERE key = ?', (key,))
+        self.conn.execute(
+                'INSERT OR REPLACE INTO docs VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row + signature)
+        self.conn.executemany('INSERT OR IGNORE INTO tags VALUES (?, ?)',
+                              tags)
+
+    def _update_hash(self, key, paths, mtime):
+        ''' Store the hash of a document's PDF, as read from its metadata. '''
+        if mtime == 0:
+            self.conn.execute('DELETE FROM hashes WHERE key = ?', (key,))
+            return
+        with open(paths.hash_path) as f:
+            pdf_hash = f.read().strip()
+        self.conn.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)',
+                          (key, pdf_hash, mtime))
+
+    def _remove(self, key):
+        self._columns = None
+        self.conn.execute('DELETE FROM tags WHERE key = ?', (key,))
+        self.conn.execute('DELETE FROM hashes WHERE key = ?', (key,))
+        self.conn.execute('DELETE FROM docs WHERE key = ?', (key,))
+
+    def is_empty(self):
+        return self.conn.execute('SELECT 1 FROM docs LIMIT 1').fetchone() is None
+
+    def set_tags(self, key, tags):
+        ''' Update the tags of a document after they have been changed in the
+            archive. '''
+        if self.conn.execute('SELECT 1 FROM docs WHERE key = ?',
+                             (key,)).fetchone() is None:
+            self._update(key)
+        else:
+            self._columns = None
+            paths = DocumentPaths(self.archive_path, key)
+            self.conn.execute('DELETE FROM tags WHERE key = ?', (key,))
+            self.conn.executemany('INSERT OR IGNORE INTO tags VALUES (?, ?)',
+                                  [(tag, key) for tag in tags])
+            self.conn.execute('UPDATE docs SET tag_mtime = ? WHERE key = ?',
+                              (_mtime(paths.tag_path), key))
+        self.conn.commit()
+
+    def tag_counts(self):
+        ''' Return a list of (tag, count) tuples, ordered from most to least
+            frequent. '''
+        rows = self.conn.execute(
+                'SELECT tag, count FROM tag_counts ORDER BY count DESC')
+        return rows.fetchall()
+
+    def tagged(self, tags):
+        ''' Return the set of keys of the documents that have all of the tags,
+            by intersecting the posting list of each tag. '''
+        postings = []
+        for tag in tags:
+            rows = self.conn.execute('SELECT key FROM tags WHERE tag = ?',
+                                     (tag,))
+            postings.append({row[0] for row in rows})
+
+        # Start from the rarest tag so that the intermediate sets are small.
+        postings.sort(key=len)
+        keys = postings[0]
+        for posting in postings[1:]:
+            keys = keys.intersection(posting)
+        return keys
+
+    def with_hash(self, pdf_hash):
+        ''' Return the keys of the documents whose PDF has the given hash. '''
+        rows = self.conn.execute('SELECT key FROM hashes WHERE hash = ?',
+                                 (pdf_hash,))
+        return [row[0] for row in rows]
+
+    def unhashed(self):
+        ''' Return the keys of the documents with no stored PDF hash. '''
+        rows = self.conn.execute('SELECT key FROM docs WHERE key NOT IN '
+                                 '(SELECT key FROM hashes)')
+        return [row[0] for row in rows]
+
+    def duplicates(self):
+        ''' Return a list of groups of keys whose PDFs have the same hash. '''
+        rows = self.conn.execute(
+                "SELECT group_concat(key, ' ') FROM hashes GROUP BY hash "
+                "HAVING count(*) > 1")
+        return [sorted(row[0].split()) for row in rows]
+
+    def _refresh_key(self, key, stored, stored_hash_mtime):
+        ''' Update the entry of a single document if any of its files have
+            changed since the stored signature was taken. Returns True if the
+            entry was updated. '''
+        paths = DocumentPaths(self.archive_path, key)
+        with profiling.phase('catalog stat'):
+            signature = _signature(paths)
+            hash_mtime = _mtime(paths.hash_path)
+        changed = False
+        if stored != signature:
+            with profiling.phase('catalog update'):
+                self._update(key)
+            changed = True
+        if stored_hash_mtime != hash_mtime:
+            self._update_hash(key, paths, hash_mtime)
+            changed = True
+        return changed
+
+    def refresh(self):
+        ''' Bring the catalog up to date with the archive. Only documents
+            whose files have changed since they were last cataloged are
+            parsed. '''
+        rows = self.conn.execute(
+                'SELECT key, bib_mtime, tag_mtime, accessed_mtime FROM docs')
+        stored = {row[0]: tuple(row[1:]) for row in rows}
+        rows = self.conn.execute('SELECT key, hash_mtime FROM hashes')
+        stored_hashes = dict(rows.fetchall())
+
+        try:
+            with profiling.phase('archive listing'):
+                keys = os.listdir(self.archive_path)
+            for key in keys:
+                self._refresh_key(key, stored.get(key),
+                                  stored_hashes.get(key, 0))
+
+            for key in set(stored).difference(keys):
+                self._remove(key)
+        finally:
+            self.conn.commit()
+
+    def refresh_keys(self, keys):
+        ''' Bring the entries of some documents up to date, without looking
+            at the rest of the archive. Documents that no longer exist are
+            removed. Returns the set of keys whose entries were updated. '''
+        changed = set()
+        try:
+            for key in keys:
+                if not os.path.isdir(os.path.join(self.archive_path, key)):
+                    self._remove(key)
+                    continue
+                row = self.conn.execute(
+                        'SELECT bib_mtime, tag_mtime, accessed_mtime FROM docs '
+                        'WHERE key = ?', (key,)).fetchone()
+                hash_row = self.conn.execute(
+                        'SELECT hash_mtime FROM hashes WHERE key = ?',
+                        (key,)).fetchone()
+                if self._refresh_key(key, tuple(row) if row else None,
+                                     hash_row[0] if hash_row else 0):
+                    changed.add(key)
+        finally:
+            self.conn.commit()
+        return changed
+
+    def columns(self):
+        ''' Return the in-memory columnar copy of the catalog, loading it
+            if the catalog has changed since it was last loaded. '''
+        from .columns import FIELDS, CatalogColumns
+
+        # data_version only changes when another connection modifies the
+        # database, so changes made through this one are tracked separately.
+        version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+        if self._columns is None or version != self._columns_version:
+            # Plain tuples are much cheaper to load than sqlite3.Row.
+            cursor = self.conn.cursor()
+            cursor.row_factory = None
+            with profiling.phase('catalog query'):
+                rows = cursor.execute('SELECT {} FROM docs'.format(
+                    ', '.join(FIELDS))).fetchall()
+                tag_rows = cursor.execute(
+                        'SELECT tag, key FROM tags').fetchall()
+            self._columns = CatalogColumns(rows, tag_rows)
+            self._columns_version = version
+        return self._columns
+
+    def plan(self, tmpl):
+        ''' Plan the evaluation of the metadata filters of a template. '''
+        from .planner import QueryPlan
+        return QueryPlan(self.columns(), tmpl)
+
+    def search(self, tmpl, plan=None):
+        ''' Generate the documents matching the metadata filters of the
+            template, evaluated according to plan, which is made if not
+            given. The text filter is not applied. '''
+        if plan is None:
+            plan = self.plan(tmpl)
+        columns = plan.columns
+        for i in plan.run():
+            key = columns.keys[i]
+            paths = DocumentPaths(self.archive_path, key)
+            yield CatalogDocument(key, paths, columns.row(i),
+                                  columns.doc_tags[i])
@@ -0,0 +1,86 @@
+import json
+import os
+import socket
+import stat
+import sys
+
+from . import profiling
+
+
+# Commands that may be forwarded to a running server. These don't need a
+# terminal and don't depend on state from the client other than its working
+# directory.
+FORWARDED_COMMANDS = ['browse', 'search', 'grep', 'where', 'complete', 'tags']
+
+# The socket is kept in a directory of its own that only the user can
+# access, since /tmp is writable by everyone.
+SOCKET_DIR_NAME = 'lib-{}'.format(os.getuid())
+SOCKET_NAME = 'lib.sock'
+
+
+def socket_dir():
+    ''' Directory holding the server's socket. '''
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR', '/tmp')
+    return os.path.join(runtime_dir, SOCKET_DIR_NAME)
+
+
+def socket_path():
+    ''' Path to the server's socket. '''
+    return os.path.join(socket_dir(), SOCKET_NAME)
+
+
+def is_private(path):
+    ''' Returns True if path is owned by the user, isn't a symlink, and can't
+        be accessed by anyone else. '''
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (st.st_uid == os.getuid() and not stat.S_ISLNK(st.st_mode)
+            and not st.st_mode & 0o077)
+
+
+def send(f, **message):
+    ''' Send a message as a line of JSON. '''
+    f.write(json.dumps(message).encode('utf-8') + b'\n')
+    f.flush()
+
+
+def forward(argv):
+    ''' Run a command on the server, if one is running, and write its output
+        to stdout. Returns the exit status of the command, or None if it
+        should be run in-process instead. '''
+    if not argv or argv[0] not in FORWARDED_COMMANDS:
+        return None
+
+    # Profiling is only meaningful for commands run in-process.
+    if profiling.env_setting()[0]:
+        return None
+
+    # Never talk to a socket that another user could have created, which
+    # would receive the command line and could inject output.
+    path = socket_path()
+    if not is_private(socket_dir()) or not is_private(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    output = False
+    with sock, sock.makefile('rwb') as f:
+        send(f, argv=argv, cwd=os.getcwd(), isatty=sys.stdout.isatty())
+        for line in f:
+            message = json.loads(line.decode('utf-8'))
+            if 'output' in message:
+                sys.stdout.write(message['output'])
+                output = True
+            else:
+                return message['status']
+
+    # The server went away. If it didn't get as far as producing any output,
+    # the command can just be run in-process.
+    return 1 if output else None
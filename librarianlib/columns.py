@@ -0,0 +1,134 @@
+from . import profiling
+from .catalog import AUTHOR_SEPARATOR
+
+# Code of a missing value in an interned column.
+MISSING = -1
+
+# Libraries with at least this many documents are filtered with numpy.
+# Smaller ones are filtered in plain Python, which is only a few milliseconds
+# slower even at this size, whereas importing numpy takes over 100 ms.
+VECTORIZE_MIN_DOCS = 50000
+
+# Columns of the catalog's docs table that are loaded, in order.
+FIELDS = ('key', 'title', 'authors', 'year', 'venue', 'entrytype', 'added',
+          'accessed')
+
+
+class _InternedColumn(object):
+    ''' A column of strings stored as integer codes into a table of its
+        distinct values, so that a test need only be run once per distinct
+        value. The codes are a list, or a numpy array if vectorized. '''
+    def __init__(self, values, vectorized=False):
+        self.values = []
+        index = {}
+        codes = []
+        counts = []
+        for value in values:
+            if value is None:
+                codes.append(MISSING)
+                continue
+            code = index.get(value)
+            if code is None:
+                code = index[value] = len(self.values)
+                self.values.append(value)
+                counts.append(0)
+            codes.append(code)
+            counts[code] += 1
+        if vectorized:
+            import numpy as np
+            codes = np.array(codes, dtype=np.int32)
+        self.codes = codes
+        self.index = index
+        self._counts = counts
+
+    def codes_where(self, test):
+        ''' Codes of the distinct values that pass test. Missing values never
+            pass. '''
+        return [code for code, value in enumerate(self.values) if test(value)]
+
+    def codes_in(self, values):
+        ''' Codes of the distinct values that are in values. '''
+        return [self.index[value] for value in values if value in self.index]
+
+    def count(self, codes):
+        ''' Number of rows with one of the codes, from a histogram of the
+            column. '''
+        return sum(self._counts[code] for code in codes)
+
+
+class CatalogColumns(object):
+    ''' In-memory columnar copy of the catalog, which the query planner
+        filters. Filters on the year, entry type, venue, and tags test
+        interned codes and tag sets, and the regexes on the key, title, and
+        authors are run on one document at a time. Large libraries are
+        vectorized: the codes and tags are held in numpy arrays instead, which
+        are filtered over many documents at once. '''
+    def __init__(self, rows, tag_rows):
+        ''' rows are tuples of the FIELDS of the catalog's docs table, and
+            tag_rows are (tag, key) tuples. '''
+        with profiling.phase('catalog columns'):
+            if rows:
+                (self.keys, self.titles, authors, year, venue, entrytype,
+                 added, accessed) = (list(column) for column in zip(*rows))
+            else:
+                (self.keys, self.titles, authors, year, venue, entrytype,
+                 added, accessed) = ([] for _ in FIELDS)
+            self.positions = {key: i for i, key in enumerate(self.keys)}
+            self.vectorized = len(self.keys) >= VECTORIZE_MIN_DOCS
+            self._authors = authors
+            self._added = added
+            self._accessed = accessed
+            # Authors are matched separated by spaces.
+            self.authors = [a.replace(AUTHOR_SEPARATOR, ' ') for a in authors]
+
+            self.year = _InternedColumn(year, self.vectorized)
+            self.entrytype = _InternedColumn(entrytype, self.vectorized)
+            self.venue = _InternedColumn(venue, self.vectorized)
+
+            # The set of positions of the documents with each tag, or a
+            # boolean column per tag if vectorized, along with the tags of
+            # each document.
+            tag_positions = {}
+            self.doc_tags = [[] for _ in self.keys]
+            for tag, key in tag_rows:
+                i = self.positions.get(key)
+                if i is None:
+                    continue
+                tag_positions.setdefault(tag, []).append(i)
+                self.doc_tags[i].append(tag)
+            self._tag_counts = {tag: len(positions)
+                                for tag, positions in tag_positions.items()}
+            if self.vectorized:
+                import numpy as np
+                self.tags = {}
+                for tag, positions in tag_positions.items():
+                    self.tags[tag] = np.zeros(len(self.keys), dtype=bool)
+                    self.tags[tag][positions] = True
+            else:
+                self.tags = {tag: set(positions)
+                             for tag, positions in tag_positions.items()}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def row(self, i):
+        ''' The catalog row of the document at position i, as a dictionary
+            of its FIELDS. '''
+        year = self.year.codes[i]
+        venue = self.venue.codes[i]
+        entrytype = self.entrytype.codes[i]
+        return {
+            'key': self.keys[i],
+            'title': self.titles[i],
+            'authors': self._authors[i],
+            'year': self.year.values[year] if year != MISSING else None,
+            'venue': self.venue.values[venue] if venue != MISSING else None,
+            'entrytype': (self.entrytype.values[entrytype]
+                          if entrytype != MISSING else None),
+            'added': self._added[i],
+            'accessed': self._accessed[i],
+        }
+
+    def tag_count(self, tag):
+        ''' Number of documents with a tag. '''
+        return self._tag_counts.get(tag, 0)
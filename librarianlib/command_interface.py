@@ -1,11 +1,10 @@
+import collections
 import os
-import shutil
-import subprocess
 import textwrap
 
-import editor
-
 from . import style
+from .exceptions import LibraryException
+from .management import find_pairs, read_manifest
 
 
 def _summarize_doc(doc, count, verbosity):
@@ -60,7 +59,14 @@ class LibraryCommandInterface(object):
         ''' Open a document for viewing. '''
         key = _sanitize_key(kwargs['key'])
         doc = self.manager.get_doc(key)
+        if kwargs['bib'] or kwargs['tag']:
+            # Refuse before the editor opens rather than after the edits.
+            self.manager.check_writable()
         doc.access()
+
+        # Only needed when editing, so not imported at startup.
+        import editor
+
         if kwargs['bib']:
             editor.edit(doc.paths.bib_path)
         elif kwargs['tag']:
@@ -70,7 +76,9 @@ class LibraryCommandInterface(object):
             # created during the editing process. Just ignore this.
             except FileNotFoundError:
                 pass
+            self.manager.update_tags(key)
         else:
+            import subprocess
             cmd = 'nohup xdg-open {} >/dev/null 2>&1 &'.format(doc.paths.pdf_path)
             subprocess.run(cmd, shell=True)
 
@@ -102,54 +110,85 @@ class LibraryCommandInterface(object):
         sort = kwargs['sort']
         number = kwargs['number']
         reverse = kwargs['reverse']
+        verify = kwargs['verify']
         verbosity = kwargs['verbose'] if kwargs['verbose'] else 0
 
+        if kwargs['explain']:
+            plan = self.manager.explain_search(key=key, title=title,
+                                               author=author, year=year,
+                                               venue=venue,
+                                               entrytype=entrytype, text=text,
+                                               tags=tags, verify=verify)
+            print(plan.explain())
+            return
+
         results = self.manager.search_docs(key=key, title=title, author=author,
                                            year=year, venue=venue,
                                            entrytype=entrytype, text=text,
                                            tags=tags, sort=sort,
-                                           reverse=reverse)
-        # Limit the number of results.
-        if number:
-            results = results[:number]
+                                           reverse=reverse, number=number,
+                                           verify=verify)
 
-        # Format the results.
-        summaries = []
-        for doc, count in results:
-            summaries.append(_summarize_doc(doc, count, verbosity))
-
-        if len(summaries) == 0:
-            return
-        elif verbosity > 0:
-            summary = '\n\n'.join(summaries)
-        else:
-            summary = '\n'.join(summaries)
-        print(summary)
+        # Print the results as they are found.
+        for i, (doc, count) in enumerate(results):
+            if i > 0 and verbosity > 0:
+                print()
+            print(_summarize_doc(doc, count, verbosity), flush=True)
 
     def compile(self, **kwargs):
         ''' Compile a single bibtex file and/or a single directory of PDFs. '''
-        docs = self.manager.all_docs()
-
         # Compile all bibtex into a single file.
         if kwargs['bib']:
-            bibtex = '\n\n'.join([doc.bibtex_str for doc in docs])
-            with open('bibtex.bib', 'w') as f:
-                f.write(bibtex)
-            print('Compiled bibtex files to bibtex.bib.')
+            output = kwargs['output']
+            if self.manager.compile_bibtex(output, force=kwargs['force']):
+                print('Compiled bibtex files to {}.'.format(output))
+            else:
+                print('{} is up to date.'.format(output))
 
         # Compile all PDFs into a single directory.
         if kwargs['text']:
-            os.mkdir('text')
-            for doc in docs:
-                shutil.copy(doc.paths.pdf_path, 'text')
-            print('Copied PDFs to text/.')
+            updated, current, removed = self.manager.compile_pdfs(
+                    'text', link=kwargs['link'], jobs=kwargs['jobs'])
+            print('Updated {} PDFs in text/ ({} up to date, {} removed).'.format(
+                updated, current, removed))
+
+    def extract(self, **kwargs):
+        ''' Extract the text of all documents with stale cached text. '''
+        keys = kwargs['key']
+        if keys is not None:
+            keys = [_sanitize_key(key) for key in keys]
+
+        statuses = collections.Counter()
+        results = self.manager.extract(keys=keys, jobs=kwargs['jobs'],
+                                       timeout=kwargs['timeout'],
+                                       verify=kwargs['verify'])
+        for key, status in results:
+            statuses[status] += 1
+            if status == 'failed':
+                print('Failed to extract text of {}.'.format(key))
+            elif status == 'timeout':
+                print('Timed out extracting text of {}.'.format(key))
+
+        print('Extracted text of {} documents ({} failed, {} timed out).'.format(
+            statuses['extracted'], statuses['failed'], statuses['timeout']))
+
+        if kwargs['corpus']:
+            count, size = self.manager.build_corpus()
+            print('Wrote corpus of {} documents ({:.1f} MB).'.format(
+                count, size / 1e6))
 
     def add(self, **kwargs):
         ''' Add a PDF and associated bibtex file to the archive. '''
+        if kwargs['batch'] or kwargs['manifest']:
+            return self._add_batch(**kwargs)
+
         pdf_file_name = kwargs['pdf']
         bib_file_name = kwargs['bibtex']
+        if pdf_file_name is None or bib_file_name is None:
+            raise LibraryException('A PDF and a bibtex file are required.')
 
-        doc = self.manager.add(pdf_file_name, bib_file_name)
+        doc = self.manager.add(pdf_file_name, bib_file_name,
+                               allow_duplicate=kwargs['allow_duplicate'])
 
         if kwargs['delete']:
             os.remove(pdf_file_name)
@@ -160,6 +199,122 @@ class LibraryCommandInterface(object):
 
         print('Archived to {}.'.format(doc.key))
 
+    def _add_batch(self, **kwargs):
+        ''' Add every pair of PDF and bibtex files in a directory or
+            manifest. '''
+        pairs = []
+        unpaired = []
+        if kwargs['batch']:
+            pairs, unpaired = find_pairs(kwargs['batch'])
+        if kwargs['manifest']:
+            pairs.extend(read_manifest(kwargs['manifest']))
+
+        added, skipped = self.manager.add_batch(
+                pairs, jobs=kwargs['jobs'],
+                allow_duplicate=kwargs['allow_duplicate'])
+
+        for doc, pdf, bib in added:
+            if kwargs['tag']:
+                self.manager.tag(doc.key, kwargs['tag'])
+            if kwargs['delete']:
+                os.remove(pdf)
+                os.remove(bib)
+
+        for path in unpaired:
+            print('No matching PDF or bibtex file for {}.'.format(path))
+        for path, reason in skipped:
+            print('Skipped {}: {}'.format(path, reason))
+        print('Archived {} documents ({} skipped, {} unpaired).'.format(
+            len(added), len(skipped), len(unpaired)))
+
+        if kwargs['extract'] and added:
+            keys = [doc.key for doc, _, _ in added]
+            for key, status in self.manager.extract(
+                    keys=keys, jobs=kwargs['jobs'],
+                    timeout=kwargs['timeout']):
+                if status == 'failed':
+                    print('Failed to extract text of {}.'.format(key))
+                elif status == 'timeout':
+                    print('Timed out extracting text of {}.'.format(key))
+
+    def compress(self, **kwargs):
+        ''' Convert the cached text of all documents to a compression
+            format. '''
+        converted = 0
+        old_total = 0
+        new_total = 0
+        for _, old_size, new_size in self.manager.compress_text(
+                kwargs['format'], jobs=kwargs['jobs']):
+            converted += 1
+            old_total += old_size
+            new_total += new_size
+        print('Converted text of {} documents ({:.1f} MB -> {:.1f} MB).'.format(
+            converted, old_total / 1e6, new_total / 1e6))
+
+    def watch(self, **kwargs):
+        ''' Keep the catalog and text index up to date as documents in the
+            archive are changed, until interrupted. '''
+        from .watch import ArchiveWatcher
+
+        self.manager.check_writable()
+        self.manager.catalog()
+        watcher = ArchiveWatcher(self.manager.archive_path)
+        print('Watching {} for changes.'.format(self.manager.archive_path))
+
+        try:
+            for keys in watcher.changes(kwargs['delay']):
+                # Events were lost, so check every document.
+                if keys is None:
+                    self.manager.catalog()
+                    keys = self.manager.all_keys()
+
+                updated = set()
+                results = self.manager.update_index(
+                        sorted(keys), extract=not kwargs['no_extract'],
+                        timeout=kwargs['timeout'])
+                for key, status in results:
+                    if status == 'updated':
+                        updated.add(key)
+                    elif status == 'removed':
+                        print('Removed {}.'.format(key))
+                    elif status == 'invalid':
+                        print('Failed to read {}.'.format(key))
+                    elif status == 'extracted':
+                        print('Extracted text of {}.'.format(key))
+                    elif status == 'failed':
+                        print('Failed to extract text of {}.'.format(key))
+                    elif status == 'timeout':
+                        print('Timed out extracting text of {}.'.format(key))
+                if updated:
+                    print('Updated {}.'.format(', '.join(sorted(updated))))
+        finally:
+            watcher.close()
+
+    def repair(self, **kwargs):
+        ''' Write the metadata that read-only mode leaves missing, and bring
+            the indexes up to date. This writes to the library even if it is
+            configured to be read-only, but not if --read-only was passed. '''
+        statuses = collections.Counter()
+        for key, status in self.manager.repair():
+            statuses[status] += 1
+            if status == 'invalid':
+                print('Failed to read {}.'.format(key))
+            elif status == 'removed':
+                print('Removed {} from the text index.'.format(key))
+            elif status != 'indexed':
+                print('Set {} of {} to today.'.format(status, key))
+        print('Repaired {} dates and indexed the text of {} documents.'.format(
+            statuses['added date'] + statuses['accessed date'],
+            statuses['indexed']))
+
+    def dupes(self, **kwargs):
+        ''' List the groups of documents that have identical PDFs. '''
+        groups = self.manager.duplicates()
+        for keys in sorted(groups):
+            print(' '.join(keys))
+        if not groups:
+            print('No duplicate documents.')
+
     def where(self, **kwargs):
         ''' Print out library directories. '''
         print(self.manager.archive_path)
@@ -183,10 +338,11 @@ class LibraryCommandInterface(object):
         print('Renamed {} to {}.'.format(key, new_key))
 
     def add_tags(self, **kwargs):
-        keys = kwargs['keys']
-        tags = kwargs['tags']
+        ''' Add tags to documents. '''
+        keys = kwargs['key']
+        tags = kwargs['tag']
         for key in keys:
-            self.manager.get_doc(key).tag(tags)
+            self.manager.tag(_sanitize_key(key), tags)
 
     def list_tags(self, **kwargs):
         ''' List all tags. '''
@@ -196,6 +352,8 @@ class LibraryCommandInterface(object):
             print('Renamed all instances of {} to {}.'.format(current_tag, new_tag))
         else:
             tag_count_list = self.manager.get_tags()
+            if len(tag_count_list) == 0:
+                return
             n = kwargs['number'] if kwargs['number'] else len(tag_count_list)
             l = len(max(tag_count_list, key=lambda x: len(x[0]))[0])
             tmpl = '{tag:<{l}} {count}'
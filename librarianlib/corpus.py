@@ -0,0 +1,182 @@
+import json
+import mmap
+import os
+import re
+
+from . import profiling
+
+
+CORPUS_FILE_NAME = 'corpus.txt'
+CORPUS_TABLE_FILE_NAME = 'corpus.json'
+
+# Placed between the text of consecutive documents.
+SEPARATOR = b'\0'
+
+
+def _bytes_regex(regex):
+    ''' Compile a text regex for searching the UTF-8 bytes of ASCII text, or
+        return None if it can't be searched that way with the same results,
+        i.e. it isn't ASCII or uses escapes only str patterns have, such as
+        \\N{...} and \\u. '''
+    if not regex.pattern.isascii():
+        return None
+    flags = regex.flags & ~(re.UNICODE)
+    try:
+        return re.compile(regex.pattern.encode('ascii'), flags)
+    except re.error:
+        return None
+
+
+class Corpus(object):
+    ''' The extracted text of every indexed document concatenated into a
+        single file, which is memory mapped for searching. The offset table
+        records the region of the file holding each document's text, along
+        with the text index signature of the document when it was added, so
+        that a document whose text has since changed can be recognized, and
+        whether the text is ASCII. '''
+    def __init__(self, index_path):
+        self.path = os.path.join(index_path, CORPUS_FILE_NAME)
+        self.table_path = os.path.join(index_path, CORPUS_TABLE_FILE_NAME)
+        self.keys = []
+        self.starts = []
+        self.ends = []
+        self.signatures = {}
+        self.positions = {}
+        self.ascii = []
+        self.size = 0
+        self.mtime = None
+        self._mmap = None
+
+        try:
+            f = open(self.table_path)
+        except FileNotFoundError:
+            return
+        with f:
+            self.mtime = os.fstat(f.fileno()).st_mtime_ns
+            table = json.load(f)
+        self.size = table['size']
+        self.keys = table['keys']
+        self.starts = table['starts']
+        self.ends = table['ends']
+        self.signatures = {key: tuple(signature) for key, signature
+                           in zip(self.keys, table['signatures'])}
+        self.positions = {key: i for i, key in enumerate(self.keys)}
+        # Corpora written before the flag was recorded are searched as if no
+        # document were ASCII.
+        self.ascii = table.get('ascii', [False] * len(self.keys))
+
+    def contains(self, key, signature):
+        ''' Returns True if the corpus holds the document's text as of the
+            given text index signature. '''
+        return signature is not None and self.signatures.get(key) == signature
+
+    def is_stale(self):
+        ''' Returns True if the corpus has been rebuilt since it was
+            loaded. '''
+        try:
+            return os.stat(self.table_path).st_mtime_ns != self.mtime
+        except FileNotFoundError:
+            return self.mtime is not None
+
+    def _map(self):
+        ''' Map the corpus file, or return None if it doesn't match the offset
+            table, e.g. because it is being rebuilt. '''
+        if self._mmap is None:
+            try:
+                f = open(self.path, 'rb')
+            except FileNotFoundError:
+                return None
+            with f:
+                if os.fstat(f.fileno()).st_size != self.size:
+                    return None
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def counts(self, regex, keys):
+        ''' Count the matches of a text regex in the text of each of the
+            documents in keys, all of which must be in the corpus. Returns a
+            dictionary mapping keys to counts, or None if the regex can't be
+            run on the corpus.
+
+            An ASCII regex is run on the bytes of the ASCII documents, which
+            gives the same matches as on their text. The text of other
+            documents is decoded and searched with the regex itself, since
+            \\w, \\b, . and negated character classes would otherwise not
+            match their non-ASCII characters. '''
+        if not self.keys:
+            return None
+        data = self._map()
+        if data is None:
+            return None
+        bytes_regex = _bytes_regex(regex)
+
+        counts = {}
+
+        # Each document is searched within its own region of the corpus, so
+        # that no match runs into the next document. The region is sliced out
+        # of the mapping without copying it, rather than passed as pos and
+        # endpos, so that ^ and lookbehinds see the start of the document as
+        # the start of the text.
+        with profiling.phase('corpus match') as p, memoryview(data) as view:
+            for key in keys:
+                i = self.positions[key]
+                start, end = self.starts[i], self.ends[i]
+                if bytes_regex is not None and self.ascii[i]:
+                    counts[key] = len(bytes_regex.findall(view[start:end]))
+                else:
+                    text = str(view[start:end], 'utf-8')
+                    counts[key] = len(regex.findall(text))
+                p.nbytes += end - start
+        return counts
+
+    def build(self, documents):
+        ''' Rewrite the corpus from an iterable of (key, signature, text)
+            tuples. Returns the size of the corpus in bytes. '''
+        self.close()
+
+        keys = []
+        starts = []
+        ends = []
+        signatures = []
+        ascii = []
+        tmp_path = self.path + '.tmp'
+        with profiling.phase('corpus write') as p, open(tmp_path, 'wb') as f:
+            offset = 0
+            for key, signature, text in documents:
+                data = text.encode('utf-8')
+                f.write(data)
+                f.write(SEPARATOR)
+                keys.append(key)
+                starts.append(offset)
+                ends.append(offset + len(data))
+                signatures.append(list(signature))
+                ascii.append(data.isascii())
+                offset += len(data) + len(SEPARATOR)
+            p.nbytes = offset
+
+        tmp_table_path = self.table_path + '.tmp'
+        with open(tmp_table_path, 'w') as f:
+            json.dump({'size': offset, 'keys': keys, 'starts': starts,
+                       'ends': ends, 'signatures': signatures,
+                       'ascii': ascii}, f)
+
+        # A reader that loads the table in between these replacements will
+        # see that the size of the corpus doesn't match, and not use it.
+        os.replace(tmp_path, self.path)
+        os.replace(tmp_table_path, self.table_path)
+
+        self.size = offset
+        self.mtime = os.stat(self.table_path).st_mtime_ns
+        self.keys = keys
+        self.starts = starts
+        self.ends = ends
+        self.signatures = {key: tuple(signature) for key, signature
+                           in zip(keys, signatures)}
+        self.positions = {key: i for i, key in enumerate(keys)}
+        self.ascii = ascii
+        return offset
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
@@ -1,37 +1,63 @@
 import datetime
-import hashlib
+import json
 import os
+import pickle
 import re
+import select
+import signal
+import time
 
-import textract
-import bibtexparser
+# Third party libraries (textract, bibtexparser) are imported where they are
+# needed, since importing them accounts for much of the startup time of the
+# tool.
 
+from . import bibparse, profiling, textcache
 from .exceptions import LibraryException
 
 
 HASH_FILE_BUFFER_SIZE = 65536
 
+# Version of the parsed bibtex cached in each document's metadata. Bump this
+# when the parsing or customizations change, to invalidate the caches.
+BIBTEX_CACHE_VERSION = 1
 
-def _hash_pdf(pdf_path):
+# In read-only mode, loading documents never writes to the archive: missing
+# dates, PDF signatures, extracted text, and bibtex caches are used in memory
+# but not saved, until they are written by ArchivalDocument.repair.
+_read_only = False
+
+
+def set_read_only(read_only):
+    ''' Switch read-only mode on or off. '''
+    global _read_only
+    _read_only = read_only
+
+
+def hash_pdf(pdf_path):
     ''' Generate an MD5 hash of a PDF file. '''
+    import hashlib
+
     md5 = hashlib.md5()
 
-    with open(pdf_path, 'rb') as f:
+    with profiling.phase('pdf hash') as p, open(pdf_path, 'rb') as f:
         while True:
             data = f.read(HASH_FILE_BUFFER_SIZE)
             if not data:
                 break
             md5.update(data)
+            p.nbytes += len(data)
 
     return md5.hexdigest()
 
 
 def _parse_pdf_text(pdf_path):
     ''' Extract plaintext content of a PDF file. '''
+    import textract
+
     # Try using pdftotext and fallback to pdfminer if that doesn't work.
     try:
         text = textract.process(pdf_path, method='pdftotext')
-    except (TypeError, UnicodeDecodeError):
+    except (TypeError, UnicodeDecodeError, textract.exceptions.ShellError):
         try:
             text = textract.process(pdf_path, method='pdfminer')
         except (TypeError, UnicodeDecodeError, textract.exceptions.ShellError):
@@ -39,8 +65,154 @@ def _parse_pdf_text(pdf_path):
     return text.decode('utf-8')
 
 
+def _parse_pdf_text_in_child(pdf_path, timeout):
+    ''' Extract the text of a PDF in a child process, raising TimeoutError if
+        it takes longer than timeout seconds. The child leads a process group
+        of its own, so that the pdftotext or pdfminer process that textract
+        starts is killed along with it on timeout, rather than left
+        running. '''
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_fd)
+            os.setpgid(0, 0)
+            text = _parse_pdf_text(pdf_path)
+            with os.fdopen(write_fd, 'wb') as f:
+                pickle.dump(text, f)
+            status = 0
+        finally:
+            os._exit(status)
+
+    # Also set in the parent, so that the group exists before any kill.
+    try:
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+    os.close(write_fd)
+
+    # Read the result as it is written, so that the child never blocks on a
+    # full pipe.
+    chunks = []
+    deadline = time.monotonic() + timeout
+    finished = False
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([read_fd], [], [],
+                                                   remaining)[0]:
+                raise TimeoutError()
+            chunk = os.read(read_fd, 1 << 20)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        finished = True
+    finally:
+        os.close(read_fd)
+        # The child's group doesn't receive the terminal's interrupts, so it
+        # is killed on any error too.
+        if not finished:
+            os.killpg(pid, signal.SIGKILL)
+        _, status = os.waitpid(pid, 0)
+
+    if status != 0:
+        raise OSError('Failed to extract the text of {}.'.format(pdf_path))
+    return pickle.loads(b''.join(chunks))
+
+
+def _read_metadata(path):
+    ''' Read a metadata file, returning None if it does not exist. '''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read()
+
+
+def _pdf_signature(pdf_path):
+    ''' Size, modification time, and inode of a PDF file. If none of these
+        have changed, neither has the file. '''
+    stat = os.stat(pdf_path)
+    return '{} {} {}'.format(stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def _current_hash(paths, verify=False):
+    ''' Return the MD5 hash of the PDF. The hash stored in the metadata is
+        reused if the PDF's signature is unchanged since it was computed, unless
+        verify is True. '''
+    signature = _pdf_signature(paths.pdf_path)
+    old_hash = _read_metadata(paths.hash_path)
+    if (not verify and old_hash is not None
+            and _read_metadata(paths.stat_path) == signature):
+        return old_hash
+
+    pdf_hash = hash_pdf(paths.pdf_path)
+
+    # The file was touched but its contents are unchanged, so record the new
+    # signature to avoid hashing it again next time.
+    if pdf_hash == old_hash and not _read_only:
+        with open(paths.stat_path, 'w') as f:
+            f.write(signature)
+    return pdf_hash
+
+
+def _text_is_stale(paths, pdf_hash):
+    ''' Returns True if the text must be extracted from the PDF, given the
+        current hash of the PDF. '''
+    # If either the text or hash file is missing, or the old hash doesn't
+    # match the current hash, we must reparse the PDF.
+    if textcache.find_text(paths) is None:
+        return True
+    return pdf_hash != _read_metadata(paths.hash_path)
+
+
+def _make_metadata_dir(paths):
+    ''' Create the metadata directory of a document if it doesn't exist. '''
+    if not os.path.exists(paths.metadata_path):
+        os.mkdir(paths.metadata_path)
+
+
+def save_text(paths, text, pdf_hash):
+    ''' Save the text extracted from the PDF along with the PDF's hash and
+        signature. '''
+    _make_metadata_dir(paths)
+    with open(paths.hash_path, 'w') as f:
+        f.write(pdf_hash)
+    with open(paths.stat_path, 'w') as f:
+        f.write(_pdf_signature(paths.pdf_path))
+
+    # TODO it may be worth saving an indication of failure so as to
+    # avoid reparsing all the time
+    if text is not None:
+        textcache.write_text(paths, text)
+
+
+def extract_text(paths, timeout=None, verify=False):
+    ''' Extract the text of a document's PDF if its cached text is stale.
+        Returns None if the cached text is current, otherwise a tuple
+        (pdf_hash, text), where text is None if the extraction failed. Raises
+        TimeoutError if extraction takes longer than timeout seconds, in which
+        case it is run in a child process that is killed on timeout. If
+        verify is True, the PDF is always rehashed to check the cached text.
+
+        Other than the PDF's signature, this does not write to the archive,
+        so that it can be run in a worker process while the results are saved
+        by the caller. '''
+    pdf_hash = _current_hash(paths, verify)
+    if not _text_is_stale(paths, pdf_hash):
+        return None
+
+    if timeout:
+        text = _parse_pdf_text_in_child(paths.pdf_path, timeout)
+    else:
+        text = _parse_pdf_text(paths.pdf_path)
+    return pdf_hash, text
+
+
 def _bibtex_customizations(record):
     ''' Customizations to apply to bibtex record. '''
+    import bibtexparser.customization
+
     record = bibtexparser.customization.convert_to_unicode(record)
 
     # Make author names more consistent.
@@ -70,27 +242,115 @@ def _bibtex_customizations(record):
     return record
 
 
-def _load_bibtex(bib_path):
-    ''' Load bibtex information as a dictionary. '''
-
-    with open(bib_path) as f:
+def _parse_bibtex_file(bib_path):
+    ''' Parse a bibtex file. Returns a tuple (entry, text) of the entry as a
+        dictionary and the raw bibtex. Entries are parsed by bibparse, unless
+        they use syntax that only bibtexparser handles. '''
+    with profiling.phase('bibtex read') as p, open(bib_path) as f:
         text = f.read().strip()
+        p.nbytes = len(text)
+
+    with profiling.phase('bibtex parse'):
+        entry = bibparse.parse_entry(text)
+        if entry is not None:
+            try:
+                return _bibtex_customizations(entry), text
+            except:
+                msg = 'Encountered an error while processing {}.'.format(
+                    bib_path)
+                raise LibraryException(msg)
+
+    import bibtexparser
 
     # common_strings=True lets us parse the month field as "jan",
     # "feb", etc.
-    parser = bibtexparser.bparser.BibTexParser(
-            customization=_bibtex_customizations,
-            common_strings=True)
-    try:
-        bibtex = bibtexparser.loads(text, parser=parser).entries_dict
-    except:
-        msg = 'Encountered an error while processing {}.'.format(bib_path)
-        raise LibraryException(msg)
+    with profiling.phase('bibtex parse (bibtexparser)'):
+        parser = bibtexparser.bparser.BibTexParser(
+                customization=_bibtex_customizations,
+                common_strings=True)
+        try:
+            bibtex = bibtexparser.loads(text, parser=parser).entries_dict
+        except:
+            msg = 'Encountered an error while processing {}.'.format(bib_path)
+            raise LibraryException(msg)
 
     key = list(bibtex.keys())[0]
     return bibtex[key], text
 
 
+def _bib_signature(bib_path):
+    ''' Modification time and size of a bibtex file. '''
+    stat = os.stat(bib_path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _read_bibtex_cache(paths, signature):
+    ''' Return the cached (entry, text) of a document's bibtex, or None if
+        there is no cache or it was made from a different bibtex file. '''
+    try:
+        with profiling.phase('bibtex cache read'), \
+                open(paths.bibtex_cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (cache.get('version') != BIBTEX_CACHE_VERSION
+            or cache.get('signature') != signature):
+        return None
+    return cache['entry'], cache['text']
+
+
+def _write_bibtex_cache(paths, signature, entry, text):
+    ''' Cache the parsed bibtex of a document. Failing to do so, e.g. in a
+        read-only archive, isn't an error. '''
+    if _read_only:
+        return
+    cache = {'version': BIBTEX_CACHE_VERSION, 'signature': signature,
+             'entry': entry, 'text': text}
+    tmp_path = paths.bibtex_cache_path + '.tmp'
+    try:
+        _make_metadata_dir(paths)
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, paths.bibtex_cache_path)
+    except OSError:
+        pass
+
+
+def _load_bibtex(paths):
+    ''' Load bibtex information as a dictionary, along with the raw bibtex.
+        The parsed entry is cached in the metadata directory, and reused as
+        long as the bibtex file's modification time and size are
+        unchanged. '''
+    # The signature is taken before the file is read, so that a change made
+    # while it is read invalidates the cache.
+    signature = _bib_signature(paths.bib_path)
+    cached = _read_bibtex_cache(paths, signature)
+    if cached is not None:
+        return cached
+
+    entry, text = _parse_bibtex_file(paths.bib_path)
+    _write_bibtex_cache(paths, signature, entry, text)
+    return entry, text
+
+
+def _read_date_file(path):
+    ''' Read a date file, returning None if it is missing or malformed. '''
+    if not os.path.exists(path):
+        return None
+    with profiling.phase('date read'), open(path) as f:
+        date = f.read()
+    try:
+        return datetime.datetime.strptime(date, '%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+def _write_date(paths, path, date):
+    _make_metadata_dir(paths)
+    with open(path, 'w') as f:
+        f.write(date.isoformat())
+
+
 def _parse_bibtex(bibtex):
     ''' Parse the bibtex. All documents must have at least a title, author, and
         year. '''
@@ -175,6 +435,7 @@ class DocumentTemplate(object):
         self.entrytype_pattern = entrytype_pattern
         self.text_regex = _pattern_to_regex(text_pattern)
         self.tag_list = _pattern_to_list(tag_pattern)
+        self.tag_set = set(self.tag_list)
 
     def key(self, key):
         ''' Test key match. '''
@@ -217,7 +478,8 @@ class DocumentTemplate(object):
         if not self.text_regex:
             return True, 0
         text = text_func()
-        count = len(self.text_regex.findall(text))
+        with profiling.phase('regex match', len(text)):
+            count = len(self.text_regex.findall(text))
         if count == 0:
             return False, 0
         return True, count
@@ -226,10 +488,7 @@ class DocumentTemplate(object):
         ''' Test tags match. '''
         # The document must have each of the tags in the template (though of
         # course may have additional ones).
-        for tag in self.tag_list:
-            if tag not in tags:
-                return False
-        return True
+        return self.tag_set.issubset(tags)
 
 
 class DocumentPaths(object):
@@ -243,58 +502,123 @@ class DocumentPaths(object):
         self.metadata_path = os.path.join(self.key_path, '.metadata')
 
         self.hash_path = os.path.join(self.metadata_path, 'hash.md5')
+        self.stat_path = os.path.join(self.metadata_path, 'stat.txt')
         self.text_path = os.path.join(self.metadata_path, 'text.txt')
         self.accessed_path = os.path.join(self.metadata_path, 'accessed.txt')
         self.added_path = os.path.join(self.metadata_path, 'added.txt')
+        self.bibtex_cache_path = os.path.join(self.metadata_path,
+                                              'bibtex.json')
 
 
 class ArchivalDocument(object):
-    ''' A document in an archive. '''
+    ''' A document in an archive. The bibtex, tags, and dates of the document
+        are each loaded from the archive the first time they are accessed, so
+        that only the files that are actually needed are read. '''
     # path contains key
     def __init__(self, key, paths):
         self.key = key
         self.paths = paths
-
-        self.bibtex, self.bibtex_str = _load_bibtex(paths.bib_path)
-        info = _parse_bibtex(self.bibtex)
-        self.title, self.authors, self.year, self.venue, self.entrytype = info
-
-        # Load tags.
-        if os.path.exists(self.paths.tag_path):
-            with open(self.paths.tag_path) as f:
-                self.tags = f.read().strip().split()
-        else:
-            self.tags = []
-
-        # Sanity checks.
-        if not os.path.exists(self.paths.metadata_path):
-            os.mkdir(self.paths.metadata_path)
-
-        # Dates.
-        self.added_date = self._read_date('added.txt')
-        self.accessed_date = self._read_date('accessed.txt')
+        profiling.record('document init')
+
+        self._bibtex = None
+        self._bibtex_str = None
+        self._info = None
+        self._tags = None
+        self._added_date = None
+        self._accessed_date = None
+
+    @property
+    def bibtex(self):
+        if self._bibtex is None:
+            self._bibtex, self._bibtex_str = _load_bibtex(self.paths)
+        return self._bibtex
+
+    @property
+    def bibtex_str(self):
+        # The raw bibtex doesn't need to be parsed.
+        if self._bibtex_str is None:
+            with open(self.paths.bib_path) as f:
+                self._bibtex_str = f.read().strip()
+        return self._bibtex_str
+
+    def _load_info(self):
+        if self._info is None:
+            self._info = _parse_bibtex(self.bibtex)
+        return self._info
+
+    @property
+    def title(self):
+        return self._load_info()[0]
+
+    @property
+    def authors(self):
+        return self._load_info()[1]
+
+    @property
+    def year(self):
+        return self._load_info()[2]
+
+    @property
+    def venue(self):
+        return self._load_info()[3]
+
+    @property
+    def entrytype(self):
+        return self._load_info()[4]
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            with profiling.phase('tags read'):
+                if os.path.exists(self.paths.tag_path):
+                    with open(self.paths.tag_path) as f:
+                        self._tags = f.read().strip().split()
+                else:
+                    self._tags = []
+        return self._tags
+
+    @property
+    def added_date(self):
+        if self._added_date is None:
+            self._added_date = self._read_date(self.paths.added_path)
+        return self._added_date
+
+    @property
+    def accessed_date(self):
+        if self._accessed_date is None:
+            self._accessed_date = self._read_date(self.paths.accessed_path)
+        return self._accessed_date
 
     def _save_tags(self):
         ''' Save list of tags to a file. '''
         with open(self.paths.tag_path, 'w') as f:
             f.write('\n'.join(self.tags))
 
-    def _read_date(self, fname):
-        path = os.path.join(self.paths.metadata_path, fname)
-        if os.path.exists(path):
-            with open(path) as f:
-                date = f.read()
-            try:
-                return datetime.datetime.strptime(date, '%Y-%m-%d')
-            # Malformed date.
-            except ValueError:
-                pass
-
-        date = datetime.date.today()
-        with open(path, 'w') as f:
-            f.write(date.isoformat())
+    def _read_date(self, path):
+        date = _read_date_file(path)
+        if date is None:
+            # The date is missing or malformed, so today's date is used, and
+            # saved unless in read-only mode.
+            date = datetime.date.today()
+            if not _read_only:
+                _write_date(self.paths, path, date)
         return date
 
+    def repair(self):
+        ''' Write the metadata that loading the document in read-only mode
+            leaves unsaved: today's date for a missing or malformed added or
+            accessed date, and the cache of the parsed bibtex. Returns a list
+            of the dates that were written. '''
+        repaired = []
+        today = datetime.date.today()
+        for name, path in [('added date', self.paths.added_path),
+                           ('accessed date', self.paths.accessed_path)]:
+            if _read_date_file(path) is None:
+                _write_date(self.paths, path, today)
+                repaired.append(name)
+        _load_bibtex(self.paths)
+        return repaired
+
     def rename_tag(self, current_tag, new_tag):
         ''' Rename a tag, if it has been applied to this document. '''
         try:
@@ -313,46 +637,32 @@ class ArchivalDocument(object):
             self.tags.append(tags)
         self._save_tags()
 
-    def text(self):
-        ''' Retrieve the plain text of the PDF file.
+    def text(self, verify=False):
+        ''' Retrieve the plain text of the PDF file. The PDF is only rehashed
+            to check the cached text if it has been modified, or verify is
+            True.
             Returns a tuple (text, new) : (str, bool)'''
-        current_hash = _hash_pdf(self.paths.pdf_path)
-
-        if os.path.exists(self.paths.hash_path):
-            with open(self.paths.hash_path) as f:
-                old_hash = f.read()
-        else:
-            old_hash = None
+        current_hash = _current_hash(self.paths, verify)
 
-        # If either the text or hash file is missing, or the old hash doesn't
-        # match the current hash, we must reparse the PDF.
-        if (not os.path.exists(self.paths.text_path)
-                or not os.path.exists(self.paths.hash_path)
-                or current_hash != old_hash):
+        if _text_is_stale(self.paths, current_hash):
             new = True
-            text = _parse_pdf_text(self.paths.pdf_path)
-
-            # Save the hash.
-            with open(self.paths.hash_path, 'w') as f:
-                f.write(current_hash)
-
-            # TODO it may be worth saving an indication of failure so as to
-            # avoid reparsing all the time
-            if text is not None:
-                with open(self.paths.text_path, 'w') as f:
-                    f.write(text)
+            with profiling.phase('text extract'):
+                text = _parse_pdf_text(self.paths.pdf_path)
+            if not _read_only:
+                save_text(self.paths, text, current_hash)
         else:
             new = False
-            with open(self.paths.text_path) as f:
-                text = f.read()
+            text = textcache.read_text(self.paths)
 
         return text, new
 
     def access(self):
-        ''' Update the access date to today. '''
-        self.accessed_date = datetime.date.today()
-        with open(self.paths.accessed_path, 'w') as f:
-            f.write(self.accessed_date.isoformat())
+        ''' Update the access date to today. In read-only mode, it is only
+            updated in memory. '''
+        self._accessed_date = datetime.date.today()
+        if not _read_only:
+            _write_date(self.paths, self.paths.accessed_path,
+                        self._accessed_date)
 
     def matches(self, tmpl):
         ''' Returns a tuple of the form (result, count). The result is True if
@@ -374,7 +684,11 @@ class ArchivalDocument(object):
             return False, 0
         if not tmpl.tags(self.tags):
             return False, 0
+        return self.matches_text(tmpl)
 
+    def matches_text(self, tmpl):
+        ''' Returns a tuple (result, count) for the text pattern of the
+            template alone. '''
         def _text_func():
             text, _ = self.text()
             return text
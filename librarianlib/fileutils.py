@@ -0,0 +1,136 @@
+import errno
+import os
+import shutil
+import stat
+
+
+# ioctl request for cloning a file on filesystems that support reflinks
+# (btrfs, XFS, etc.), from linux/fs.h.
+FICLONE = 0x40049409
+
+COPY_CHUNK_SIZE = 1 << 30
+
+# Errors meaning that a fast copy path isn't available, so that the next one
+# should be tried.
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP,
+                       errno.EINVAL, errno.ENOTTY, errno.EBADF}
+
+
+def _copy_range(src, dest, size):
+    ''' Copy a file within the kernel using copy_file_range or sendfile.
+        Returns False if neither is supported. '''
+    for func in ['copy_file_range', 'sendfile']:
+        if not hasattr(os, func):
+            continue
+        copied = 0
+        try:
+            while copied < size:
+                if func == 'copy_file_range':
+                    n = os.copy_file_range(src.fileno(), dest.fileno(),
+                                           COPY_CHUNK_SIZE)
+                else:
+                    n = os.sendfile(dest.fileno(), src.fileno(), copied,
+                                    COPY_CHUNK_SIZE)
+                if n == 0:
+                    break
+                copied += n
+            return True
+        except OSError as e:
+            # Only fall back if nothing has been copied yet.
+            if e.errno not in _UNSUPPORTED_ERRNOS or copied > 0:
+                raise
+    return False
+
+
+def copy_file(src_path, dest_path):
+    ''' Copy a file, letting the kernel do the copying when possible. The
+        modification time of the source is preserved. '''
+    with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+        size = os.fstat(src.fileno()).st_size
+        if not _copy_range(src, dest, size):
+            shutil.copyfileobj(src, dest)
+    shutil.copystat(src_path, dest_path)
+
+
+def reflink(src_path, dest_path):
+    ''' Clone a file, such that the copy shares its data with the source
+        until either is modified. Falls back to a copy if the filesystem
+        doesn't support it. '''
+    import fcntl
+
+    with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+        try:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+            cloned = True
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            cloned = False
+    if not cloned:
+        copy_file(src_path, dest_path)
+    else:
+        shutil.copystat(src_path, dest_path)
+
+
+def _replace_with(func, src_path, dest_path):
+    ''' Create dest_path from src_path using func, replacing any existing file
+        atomically. '''
+    tmp_path = dest_path + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    func(src_path, tmp_path)
+    os.replace(tmp_path, dest_path)
+
+
+def is_up_to_date(src_path, dest_path, link=None):
+    ''' Returns True if dest_path is already a copy of (or link to, depending
+        on the link mode) src_path. A file mirrored in another link mode is
+        not up to date, so that e.g. a hard link is replaced by a copy when
+        copying, and editing the mirror doesn't change the source. '''
+    try:
+        if link == 'sym':
+            return os.readlink(dest_path) == src_path
+        src = os.stat(src_path)
+        dest = os.stat(dest_path, follow_symlinks=False)
+    except OSError:
+        return False
+    if stat.S_ISLNK(dest.st_mode):
+        return False
+    if link == 'hard':
+        return os.path.samestat(src, dest)
+    return (not os.path.samestat(src, dest)
+            and src.st_size == dest.st_size
+            and src.st_mtime_ns == dest.st_mtime_ns)
+
+
+def mirror_file(src_path, dest_path, link=None):
+    ''' Make dest_path a copy of src_path. link may be None to copy the file,
+        'hard' or 'sym' for a hard or symbolic link, or 'reflink' to clone
+        it. '''
+    if link == 'hard':
+        _replace_with(os.link, src_path, dest_path)
+    elif link == 'sym':
+        _replace_with(os.symlink, src_path, dest_path)
+    elif link == 'reflink':
+        _replace_with(reflink, src_path, dest_path)
+    else:
+        _replace_with(copy_file, src_path, dest_path)
+
+
+def connect_read_only(db_path):
+    ''' Open an SQLite database without allowing any writes to it. Returns
+        None if the database doesn't exist or can't be read. '''
+    import sqlite3
+    import urllib.parse
+
+    if not os.path.exists(db_path):
+        return None
+    path = urllib.parse.quote(os.path.abspath(db_path))
+    uri = 'file:{}?mode=ro'.format(path)
+    try:
+        conn = sqlite3.connect(uri, uri=True)
+        # Connecting is lazy, so check that the file is in fact a database.
+        conn.execute('PRAGMA user_version')
+    except sqlite3.Error:
+        return None
+    return conn
@@ -1,19 +1,34 @@
 # Built-in.
+import heapq
+import itertools
+import json
 import os
 import shutil
-import yaml
 
-# Third party.
-import bibtexparser
-from bibtexparser.bwriter import BibTexWriter
-import pyparsing
+# Third party libraries (yaml, bibtexparser, pyparsing), as well as anything
+# that isn't needed by every command, are imported where they are used to
+# keep startup fast.
 
 # Ours.
-from .document import DocumentPaths, ArchivalDocument, DocumentTemplate
+from . import bibparse, document, fileutils, profiling, textcache
+from .document import (DocumentPaths, ArchivalDocument, DocumentTemplate,
+                       extract_text, hash_pdf, save_text)
 from .exceptions import LibraryException
 
 
-def _find_config(search_dirs, config_name):
+COMPILE_MANIFEST_FILE_NAME = 'compile.json'
+
+
+def _file_signature(path):
+    ''' Modification time and size of a file, or None if it doesn't exist. '''
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def find_config(search_dirs, config_name):
     ''' Find the path to the configuration file. '''
     for search_dir in search_dirs:
         path = os.path.join(search_dir, config_name)
@@ -25,10 +40,18 @@ def _find_config(search_dirs, config_name):
 def _key_from_bibtex(bib_path):
     ''' Extract the document key from a bibtex file. '''
     with open(bib_path) as bib_file:
-        try:
-            bib_info = bibtexparser.load(bib_file)
-        except pyparsing.ParseException:
-            raise LibraryException('Failed to parse bibtex file.')
+        text = bib_file.read()
+    entry = bibparse.parse_entry(text)
+    if entry is not None:
+        return entry['ID']
+
+    import bibtexparser
+    import pyparsing
+
+    try:
+        bib_info = bibtexparser.loads(text)
+    except pyparsing.ParseException:
+        raise LibraryException('Failed to parse bibtex file.')
 
     keys = list(bib_info.entries_dict.keys())
     if len(keys) > 1:
@@ -37,24 +60,137 @@ def _key_from_bibtex(bib_path):
     return keys[0]
 
 
+def _inspect_pair(pair):
+    ''' Extract the document key from the bibtex file of a (pdf, bib) pair and
+        hash the PDF. Returns a tuple (key, pdf_hash, error), where error is
+        None unless one of the files couldn't be read. '''
+    pdf_path, bib_path = pair
+    try:
+        return _key_from_bibtex(bib_path), hash_pdf(pdf_path), None
+    except LibraryException as e:
+        return None, None, e.message
+    except (OSError, IndexError):
+        return None, None, 'Failed to read files.'
+
+
+def find_pairs(directory):
+    ''' Pair each PDF in a directory with the bibtex file of the same name.
+        Returns a tuple (pairs, unpaired), where pairs is a list of (pdf, bib)
+        path tuples and unpaired is a list of files without a partner. '''
+    if not os.path.isdir(directory):
+        raise LibraryException('{} is not a directory!'.format(directory))
+    pdfs = {}
+    bibs = {}
+    for name in os.listdir(directory):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() == '.pdf':
+            pdfs[stem] = os.path.join(directory, name)
+        elif ext.lower() == '.bib':
+            bibs[stem] = os.path.join(directory, name)
+
+    pairs = [(pdfs[stem], bibs[stem]) for stem in sorted(pdfs) if stem in bibs]
+    unpaired = [pdfs[stem] for stem in pdfs if stem not in bibs]
+    unpaired.extend(bibs[stem] for stem in bibs if stem not in pdfs)
+    return pairs, sorted(unpaired)
+
+
+def read_manifest(manifest_path):
+    ''' Read a manifest of documents to add. Each line contains the path to a
+        PDF and the path to its bibtex file, separated by whitespace. Relative
+        paths are relative to the manifest. Blank lines and lines starting
+        with # are ignored. Returns a list of (pdf, bib) path tuples. '''
+    if not os.path.isfile(manifest_path):
+        raise LibraryException('{} does not exist!'.format(manifest_path))
+    directory = os.path.dirname(os.path.abspath(manifest_path))
+    pairs = []
+    with open(manifest_path) as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split()
+            if len(parts) != 2:
+                msg = 'Line {} of {} should contain a PDF and a bibtex ' \
+                      'file.'.format(i + 1, manifest_path)
+                raise LibraryException(msg)
+            pairs.append(tuple(os.path.join(directory, part)
+                               for part in parts))
+    return pairs
+
+
 class LibraryManager(object):
     ''' Manager for the library. Handles all interactions with it. '''
     def __init__(self, search_dirs, config_name):
-        config_file_path = _find_config(search_dirs, config_name)
+        config_file_path = find_config(search_dirs, config_name)
         if config_file_path is None:
             raise LibraryException('Could not find config file.')
+        self.config_file_path = config_file_path
 
+        import yaml
         with open(config_file_path) as f:
-            config = yaml.load(f)
+            config = yaml.safe_load(f)
 
         self.path = os.path.expanduser(config['library'])
+        textcache.configure(config.get('text_compression'))
         self.archive_path = os.path.join(self.path, 'archive')
+        self.index_path = os.path.join(self.path, '.index')
+        self._catalog = None
+        self._text_index = None
 
         # Check that the archive exists.
         if not os.path.isdir(self.archive_path):
             msg = '{} does not exist!'.format(self.archive_path)
             raise LibraryException(msg)
 
+        # Whether the configuration asks for read-only mode by default.
+        self.config_read_only = bool(config.get('read_only', False))
+        self.read_only = None
+        self.read_only_explicit = False
+        self.set_read_only(self.config_read_only)
+
+    def set_read_only(self, read_only, explicit=False):
+        ''' Switch read-only mode on or off. In read-only mode, loading and
+            searching the library writes nothing to disk, and commands that
+            modify the library are refused. explicit is whether the user
+            asked for read-only mode for this command, rather than it coming
+            from the configuration; repair refuses to override it. '''
+        read_only = bool(read_only)
+        self.read_only_explicit = read_only and bool(explicit)
+        if read_only != self.read_only:
+            # The catalog and text index are opened differently in read-only
+            # mode.
+            self._catalog = None
+            self._text_index = None
+        self.read_only = read_only
+        document.set_read_only(read_only)
+
+    def check_writable(self):
+        ''' Raise an exception if the library is in read-only mode. '''
+        if self.read_only:
+            raise LibraryException('The library is read-only.')
+
+    def catalog(self, refresh=True):
+        ''' Return the metadata catalog. If refresh is True, it is brought up
+            to date with the archive first. Otherwise, it is only as current
+            as the last command that changed it, which is good enough for
+            reading tags. '''
+        from .catalog import LibraryCatalog
+
+        if self._catalog is None:
+            self._catalog = LibraryCatalog(self.index_path, self.archive_path,
+                                           self.read_only)
+        if refresh or self._catalog.is_empty():
+            self._catalog.refresh()
+        return self._catalog
+
+    def text_index(self):
+        ''' Return the full-text index. '''
+        from .textindex import TextIndex
+
+        if self._text_index is None:
+            self._text_index = TextIndex(self.index_path, self.read_only)
+        return self._text_index
+
     def has_key(self, key):
         ''' Returns True if the key is in the archive, false otherwise. '''
         return os.path.isdir(os.path.join(self.archive_path, key))
@@ -79,25 +215,100 @@ class LibraryManager(object):
         paths = DocumentPaths(self.archive_path, key)
         return ArchivalDocument(key, paths)
 
-    def add(self, pdf_src_path, bib_src_path):
-        ''' Add a new document to the archive. Returns the document. '''
+    def add(self, pdf_src_path, bib_src_path, allow_duplicate=False):
+        ''' Add a new document to the archive. Returns the document. Unless
+            allow_duplicate is True, the PDF is rejected if it is already in
+            the archive under another key. '''
+        self.check_writable()
         key = _key_from_bibtex(bib_src_path)
 
         if self.has_key(key):
             msg = 'Archive already contains key {}. Aborting.'.format(key)
             raise LibraryException(msg)
 
-        # Create document structure.
+        pdf_hash = hash_pdf(pdf_src_path)
+        if not allow_duplicate:
+            keys = self.catalog().with_hash(pdf_hash)
+            if keys:
+                msg = 'PDF is already in the archive as {}. ' \
+                      'Aborting.'.format(', '.join(keys))
+                raise LibraryException(msg)
+
+        return self._archive(key, pdf_src_path, bib_src_path, pdf_hash)
+
+    def _archive(self, key, pdf_src_path, bib_src_path, pdf_hash):
+        ''' Create the document structure for a new key. The hash of the PDF
+            is saved with it, so that it is known to the duplicate index. '''
         paths = DocumentPaths(self.archive_path, key)
         os.mkdir(paths.key_path)
         os.mkdir(paths.metadata_path)
-        shutil.copy(pdf_src_path, paths.pdf_path)
-        shutil.copy(bib_src_path, paths.bib_path)
+        fileutils.copy_file(pdf_src_path, paths.pdf_path)
+        fileutils.copy_file(bib_src_path, paths.bib_path)
+        save_text(paths, None, pdf_hash)
 
         return ArchivalDocument(key, paths)
 
+    def add_batch(self, pairs, jobs=None, allow_duplicate=False):
+        ''' Add many documents to the archive at once. The bibtex files are
+            parsed and the PDFs hashed in parallel, all of the keys and hashes
+            are checked for collisions before anything is copied, and the
+            files are then copied concurrently. Documents that can't be added
+            are skipped.
+            Params:
+                pairs - List of (pdf, bib) path tuples.
+                jobs - Number of worker processes and threads.
+                allow_duplicate - Add PDFs that are already in the archive.
+            Returns:
+                A tuple (added, skipped), where added is a list of
+                (doc, pdf, bib) tuples and skipped is a list of (pdf, reason)
+                tuples. '''
+        self.check_writable()
+        import concurrent.futures
+
+        skipped = []
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(_inspect_pair, pairs, chunksize=16))
+
+        # Check for collisions with the archive and within the batch.
+        existing = set(self.all_keys())
+        catalog = self.catalog()
+        batch = {}
+        batch_hashes = {}
+        for (pdf, bib), (key, pdf_hash, error) in zip(pairs, results):
+            if error is not None:
+                skipped.append((pdf, error))
+                continue
+            duplicates = [] if allow_duplicate else catalog.with_hash(pdf_hash)
+            if key in existing:
+                msg = 'Archive already contains key {}.'.format(key)
+                skipped.append((pdf, msg))
+            elif key in batch:
+                msg = 'Key {} is also used by {}.'.format(key, batch[key][0])
+                skipped.append((pdf, msg))
+            elif duplicates:
+                msg = 'PDF is already in the archive as {}.'.format(
+                    ', '.join(duplicates))
+                skipped.append((pdf, msg))
+            elif not allow_duplicate and pdf_hash in batch_hashes:
+                msg = 'Same PDF as {}.'.format(batch_hashes[pdf_hash])
+                skipped.append((pdf, msg))
+            else:
+                batch[key] = (pdf, bib, pdf_hash)
+                batch_hashes[pdf_hash] = pdf
+
+        def _archive(key):
+            pdf, bib, pdf_hash = batch[key]
+            return self._archive(key, pdf, bib, pdf_hash), pdf, bib
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            added = list(pool.map(_archive, batch))
+
+        return added, skipped
+
     def rekey(self, old_key, new_key):
         ''' Change the key of an existing document in the archive. '''
+        self.check_writable()
         old_paths = self.get_doc(old_key).paths
 
         # If a new key has not been supplied, we take the key from the bibtex
@@ -119,6 +330,9 @@ class LibraryManager(object):
         shutil.move(old_paths.key_path, new_paths.key_path)
 
         # Write the new_key to the bibtex file
+        import bibtexparser
+        from bibtexparser.bwriter import BibTexWriter
+
         with open(new_paths.bib_path, 'r') as f:
             bib_info = bibtexparser.load(f)
 
@@ -127,6 +341,10 @@ class LibraryManager(object):
         with open(new_paths.bib_path, 'w') as f:
             f.write(bib_writer.write(bib_info))
 
+        # Otherwise the text would be indexed under both keys, and counted
+        # twice in the statistics used to score relevance.
+        self.text_index().rename(old_key, new_key)
+
         return new_key
 
     def link(self, key, path):
@@ -171,24 +389,26 @@ class LibraryManager(object):
         ''' Apply one or more tags to a document.
             Params:
                 key - Key for document to tag.
-                tags - Comma-separated string of tags.
+                tags - A single tag, or a list of tags.
             Returns:
                 None '''
-        self.get_doc(key).tag(tags)
+        self.check_writable()
+        doc = self.get_doc(key)
+        doc.tag(tags)
+        self.catalog(refresh=False).set_tags(key, doc.tags)
+
+    def update_tags(self, key):
+        ''' Update the tag index after the tags of a document have been edited
+            outside of the tool. '''
+        self.check_writable()
+        doc = self.get_doc(key)
+        self.catalog(refresh=False).set_tags(key, doc.tags)
 
     def get_tags(self):
         ''' Get a list of (tag, count) tuples, ordered from most to least
-            frequent. '''
-        tag_count_map = {}
-        for doc in self.all_docs():
-            for tag in doc.tags:
-                if tag in tag_count_map:
-                    tag_count_map[tag] += 1
-                else:
-                    tag_count_map[tag] = 1
-        tag_count_list = [(tag, count) for tag, count in tag_count_map.items()]
-        tag_count_list.sort(key=lambda x: x[1], reverse=True)
-        return tag_count_list
+            frequent. The counts are read from the tag index in the catalog,
+            which is kept up to date as tags are changed. '''
+        return self.catalog(refresh=False).tag_counts()
 
     def rename_tag(self, current_tag, new_tag):
         ''' Rename all instances of a tag.
@@ -197,48 +417,415 @@ class LibraryManager(object):
                 new_tag - New tag name.
             Returns:
                 None '''
-        for doc in self.all_docs():
+        self.check_writable()
+        catalog = self.catalog()
+        for key in catalog.tagged([current_tag]):
+            doc = self.get_doc(key)
             doc.rename_tag(current_tag, new_tag)
+            catalog.set_tags(key, doc.tags)
+
+    def duplicates(self):
+        ''' Find documents that have the same PDF, using the hashes in the
+            catalog. Documents without a stored hash, which are those whose
+            text has never been extracted, are hashed first.
+            Returns:
+                A list of lists of keys. '''
+        catalog = self.catalog()
+        unhashed = catalog.unhashed()
+        if unhashed and self.read_only:
+            msg = '{} documents have no stored hash. Run dupes outside of ' \
+                  'read-only mode to hash them.'.format(len(unhashed))
+            raise LibraryException(msg)
+        for key in unhashed:
+            paths = DocumentPaths(self.archive_path, key)
+            save_text(paths, None, hash_pdf(paths.pdf_path))
+        if unhashed:
+            catalog.refresh()
+        return catalog.duplicates()
+
+    def _load_compile_manifest(self):
+        path = os.path.join(self.index_path, COMPILE_MANIFEST_FILE_NAME)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def _save_compile_manifest(self, manifest):
+        if not os.path.exists(self.index_path):
+            os.mkdir(self.index_path)
+        path = os.path.join(self.index_path, COMPILE_MANIFEST_FILE_NAME)
+        with open(path, 'w') as f:
+            json.dump(manifest, f)
+
+    def compile_bibtex(self, output_path, force=False):
+        ''' Compile the bibtex of every document into a single file. Entries
+            are streamed to the file one at a time. The file is only
+            regenerated if a bibtex file has been added, removed, or changed
+            since it was last compiled, or if force is True.
+            Params:
+                output_path - Path of the compiled bibtex file.
+                force - Regenerate the file even if it is up to date.
+            Returns:
+                True if the file was regenerated, False if it was up to
+                date. '''
+        output_path = os.path.abspath(output_path)
+
+        # Manifest of the signature of each bibtex file, by key, that went
+        # into each compiled file.
+        keys = sorted(self.all_keys())
+        bibs = {}
+        for key in keys:
+            paths = DocumentPaths(self.archive_path, key)
+            bibs[key] = _file_signature(paths.bib_path)
+
+        manifest = self._load_compile_manifest()
+        entry = manifest.get(output_path)
+        if (not force and entry is not None
+                and entry['bibs'] == bibs
+                and entry['output'] == _file_signature(output_path)):
+            return False
+
+        # Write to a temporary file so that the output is never left half
+        # written.
+        tmp_path = output_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for i, key in enumerate(keys):
+                if i > 0:
+                    f.write('\n\n')
+                paths = DocumentPaths(self.archive_path, key)
+                f.write(ArchivalDocument(key, paths).bibtex_str)
+        os.replace(tmp_path, output_path)
+
+        manifest[output_path] = {
+            'output': _file_signature(output_path),
+            'bibs': bibs,
+        }
+        # The output is written regardless, but the library is not.
+        if not self.read_only:
+            self._save_compile_manifest(manifest)
+        return True
+
+    def compile_pdfs(self, output_path, link=None, jobs=None):
+        ''' Mirror the PDF of every document into a single directory, using a
+            pool of threads. If the directory already exists, only the PDFs
+            that have changed are updated, and those of documents that are no
+            longer in the archive are removed.
+            Params:
+                output_path - Directory to compile the PDFs into.
+                link - None to copy the PDFs, or one of 'hard', 'sym', or
+                       'reflink' to link or clone them instead.
+                jobs - Number of threads.
+            Returns:
+                A tuple of the number of PDFs (updated, current, removed). '''
+        import concurrent.futures
+
+        if not os.path.exists(output_path):
+            os.mkdir(output_path)
+
+        sources = {}
+        for key in self.all_keys():
+            paths = DocumentPaths(self.archive_path, key)
+            sources[key + '.pdf'] = paths.pdf_path
+
+        removed = 0
+        for name in os.listdir(output_path):
+            if name.endswith('.pdf') and name not in sources:
+                os.remove(os.path.join(output_path, name))
+                removed += 1
+
+        def _mirror(name):
+            src_path = sources[name]
+            dest_path = os.path.join(output_path, name)
+            if fileutils.is_up_to_date(src_path, dest_path, link):
+                return False
+            fileutils.mirror_file(src_path, dest_path, link)
+            return True
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(_mirror, sources))
+        updated = sum(results)
+        return updated, len(results) - updated, removed
+
+    def extract(self, keys=None, jobs=None, timeout=None, verify=False):
+        ''' Extract the text of every document whose cached text is stale,
+            using a pool of worker processes. The text of each document is
+            saved as soon as it is extracted, so an interrupted run keeps its
+            progress.
+            Params:
+                keys - Keys of the documents to extract. Defaults to all.
+                jobs - Number of worker processes. Defaults to the number of
+                       CPUs.
+                timeout - Seconds after which to give up on a document.
+                verify - Rehash every PDF, even if it appears unmodified.
+            Returns:
+                A generator of (key, status) tuples, where status is one of
+                'extracted', 'failed', or 'timeout'. Documents with current
+                text are skipped. '''
+        self.check_writable()
+        import concurrent.futures
+
+        if keys is None:
+            keys = self.all_keys()
+        text_index = self.text_index()
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {}
+            for key in keys:
+                paths = DocumentPaths(self.archive_path, key)
+                futures[pool.submit(extract_text, paths, timeout, verify)] = paths
+
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    paths = futures[future]
+                    key = os.path.basename(paths.key_path)
+                    try:
+                        result = future.result()
+                    except TimeoutError:
+                        yield key, 'timeout'
+                        continue
+                    # A PDF that can't be extracted, e.g. because pdftotext
+                    # fails on it, mustn't stop the others.
+                    except Exception:
+                        yield key, 'failed'
+                        continue
+
+                    if result is None:
+                        continue
+                    pdf_hash, text = result
+                    save_text(paths, text, pdf_hash)
+                    text_index.update(key, paths, text)
+                    text_index.commit()
+                    yield key, 'extracted' if text is not None else 'failed'
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def build_corpus(self):
+        ''' Rebuild the corpus file that holds the text of every indexed
+            document, for regex searches. Documents whose text is not yet
+            indexed are indexed first.
+            Returns:
+                A tuple (number of documents, size in bytes). '''
+        self.check_writable()
+        text_index = self.text_index()
+        docs = self.all_docs()
+        for doc in docs:
+            if not text_index.is_current(doc.key, doc.paths):
+                text = textcache.read_text(doc.paths)
+                if text is not None:
+                    text_index.update(doc.key, doc.paths, text)
+        text_index.commit()
+        return text_index.build_corpus(docs)
+
+    def compress_text(self, fmt=None, jobs=None):
+        ''' Convert the cached text of every document to a compression format,
+            using a pool of worker processes.
+            Params:
+                fmt - Compression format. Defaults to the configured one.
+                jobs - Number of worker processes.
+            Returns:
+                A generator of (key, old_size, new_size) tuples for the
+                documents that were converted. '''
+        self.check_writable()
+        import concurrent.futures
+
+        if fmt is None:
+            fmt = textcache.current_format()
+        textcache.check_format(fmt)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {}
+            for key in self.all_keys():
+                paths = DocumentPaths(self.archive_path, key)
+                futures[pool.submit(textcache.convert, paths, fmt)] = key
+
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    sizes = future.result()
+                    if sizes is not None:
+                        yield (futures[future],) + sizes
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def update_index(self, keys, extract=True, timeout=None):
+        ''' Bring the catalog and text index up to date for some documents,
+            e.g. after their files were changed outside of the tool.
+            Params:
+                keys - Keys of the documents that may have changed.
+                extract - Extract the text of documents whose PDF changed.
+                timeout - Seconds after which to give up on extracting the
+                          text of a document.
+            Returns:
+                A generator of (key, status) tuples, where status is one of
+                'updated', 'removed', or 'invalid' if the document couldn't be
+                read, or a status of extract for documents whose text was
+                extracted. Documents that are already up to date are
+                skipped. '''
+        self.check_writable()
+        catalog = self.catalog(refresh=False)
+        text_index = self.text_index()
+
+        present = []
+        updated = set()
+        for key in keys:
+            try:
+                updated.update(catalog.refresh_keys([key]))
+            except (LibraryException, OSError, IndexError):
+                yield key, 'invalid'
+                continue
+
+            if self.has_key(key):
+                present.append(key)
+            else:
+                text_index.remove(key)
+                yield key, 'removed'
+        text_index.commit()
+
+        if extract:
+            yield from self.extract(keys=present, timeout=timeout)
+
+        # Text that was extracted elsewhere, e.g. synced from another
+        # machine, still needs to be indexed.
+        for key in present:
+            paths = DocumentPaths(self.archive_path, key)
+            if (textcache.find_text(paths) is not None
+                    and not text_index.is_current(key, paths)):
+                text_index.update(key, paths, textcache.read_text(paths))
+                updated.add(key)
+            if key in updated:
+                yield key, 'updated'
+        text_index.commit()
+
+    def repair(self):
+        ''' Write the metadata that read-only mode leaves unsaved, and bring
+            the catalog and text index up to date, in a single pass over the
+            archive. Read-only mode from the configuration is switched off for
+            the repair, but read-only mode asked for explicitly is not.
+            Returns:
+                A generator of (key, status) tuples, where status is 'added
+                date' or 'accessed date' for a date that was missing or
+                malformed and is now today's, 'invalid' if the document
+                couldn't be read, 'indexed' if its text was indexed, or
+                'removed' if it is no longer in the archive. '''
+        if self.read_only_explicit:
+            raise LibraryException('Read-only mode was requested; not '
+                                   'repairing the library.')
+        self.set_read_only(False)
+
+        keys = self.all_keys()
+        for key in keys:
+            try:
+                for status in self.get_doc(key).repair():
+                    yield key, status
+            except (LibraryException, OSError, IndexError):
+                yield key, 'invalid'
+
+        self.catalog()
+
+        # Text extracted while in read-only mode, or elsewhere, is indexed,
+        # and documents no longer in the archive are dropped from the index.
+        text_index = self.text_index()
+        for key in set(text_index.signatures).difference(keys):
+            text_index.remove(key)
+            yield key, 'removed'
+        for key in keys:
+            paths = DocumentPaths(self.archive_path, key)
+            if (textcache.find_text(paths) is not None
+                    and not text_index.is_current(key, paths)):
+                text_index.update(key, paths, textcache.read_text(paths))
+                yield key, 'indexed'
+        text_index.commit()
+
+    def explain_search(self, key=None, title=None, author=None, year=None,
+                       venue=None, entrytype=None, text=None, tags=None,
+                       verify=False):
+        ''' Run a search with the same filters as search_docs, and return
+            its QueryPlan, which records the order in which the filters were
+            evaluated and the number of documents each eliminated. '''
+        tmpl = DocumentTemplate(key, title, author, year, venue, entrytype,
+                                text, tags)
+        catalog = self.catalog()
+        plan = catalog.plan(tmpl)
+        docs = catalog.search(tmpl, plan)
+        if tmpl.text_regex:
+            plan.run_text(docs, lambda docs: self.text_index().matches(
+                tmpl, docs, verify))
+        else:
+            for _ in docs:
+                pass
+        return plan
 
     def search_docs(self, key=None, title=None, author=None, year=None,
                     venue=None, entrytype=None, text=None, tags=None,
-                    sort=None, reverse=False):
-        ''' Search documents for those that match the provided filters and
-            produce a summary of the results. '''
-        # Find documents matching the criteria.
+                    sort=None, reverse=False, number=None, verify=False):
+        ''' Search documents for those that match the provided filters.
+            Returns a generator of (doc, count) tuples, where count is the
+            number of matches of the text filter. Unsorted results are
+            generated as they are found, and the search stops once number
+            results have been found; a number of None or 0 means no limit. If
+            verify is True, every PDF is rehashed to check that its cached
+            text is current. '''
+        # Find documents matching the criteria. The metadata filters are
+        # evaluated by the catalog, in the order chosen by its planner, so
+        # only the text remains to be checked.
         tmpl = DocumentTemplate(key, title, author, year, venue, entrytype,
                                 text, tags)
-        docs = []
-        counts = []
-        for doc in self.all_docs():
-            result, count = doc.matches(tmpl)
-            if result:
-                docs.append(doc)
-                counts.append(count)
+        results = self.catalog().search(tmpl)
+        if tmpl.text_regex:
+            results = self.text_index().matches(tmpl, results, verify)
+        else:
+            results = ((doc, 0) for doc in results)
+
+        if not number:
+            number = None
+        if not sort:
+            return itertools.islice(results, number)
+
+        if sort == 'relevance':
+            if not tmpl.text_regex:
+                msg = 'Sorting by relevance requires a text filter.'
+                raise LibraryException(msg)
+            # Score the documents after the text search, which indexes any
+            # documents that weren't yet.
+            results = list(results)
+            scores = self.text_index().relevance(tmpl.text_regex)
+            if results and not scores:
+                # Only possible in read-only mode, where the search doesn't
+                # index the documents.
+                msg = 'The text index is empty, so the results cannot be ' \
+                      'sorted by relevance. Run lib repair to build it.'
+                raise LibraryException(msg)
 
         # Sort the matching documents.
-        if sort:
-            def _doc_sort_key(doc_count_tuple):
-                doc, count = doc_count_tuple
-
-                if sort == 'key':
-                    return doc.key
-                if sort == 'title':
-                    return doc.bibtex['title'].lower()
-                if sort == 'year':
-                    return doc.bibtex['year']
-                if sort == 'added':
-                    return doc.added_date
-                if sort == 'accessed':
-                    return doc.accessed_date
-                if sort == 'matches':
-                    return count
-                return doc.bibtex['year']
-
-            if sort not in ['key', 'title']:
-                reverse = not reverse
-            docs_counts = sorted(zip(docs, counts), key=_doc_sort_key,
-                                 reverse=reverse)
-            docs, counts = tuple(zip(*docs_counts))
-
-        return zip(docs, counts)
+        def _doc_sort_key(doc_count_tuple):
+            doc, count = doc_count_tuple
+
+            if sort == 'key':
+                return doc.key
+            if sort == 'title':
+                return doc.title.lower()
+            if sort == 'year':
+                return doc.year
+            if sort == 'added':
+                return doc.added_date
+            if sort == 'accessed':
+                return doc.accessed_date
+            if sort == 'matches':
+                return count
+            if sort == 'relevance':
+                return scores.get(doc.key, 0)
+            return doc.year
+
+        if sort not in ['key', 'title']:
+            reverse = not reverse
+
+        # Only the top results need to be kept when the number is limited.
+        with profiling.phase('sort'):
+            if number is None:
+                results = sorted(results, key=_doc_sort_key, reverse=reverse)
+            elif reverse:
+                results = heapq.nlargest(number, results, key=_doc_sort_key)
+            else:
+                results = heapq.nsmallest(number, results, key=_doc_sort_key)
+        return iter(results)
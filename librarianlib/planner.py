@@ -0,0 +1,220 @@
+import time
+
+from . import profiling
+
+
+# Estimated costs of testing one document, relative to running a regex on a
+# short string. Tests on interned codes and tags are a lookup per document,
+# or vectorized in large libraries, and cost little per document.
+VECTOR_COST = 0.05
+REGEX_COST = 1.0
+REGEX_CHAR_COST = 0.02
+
+# Number of documents on which a regex is tried to estimate its selectivity.
+SAMPLE_SIZE = 200
+
+
+class _Stage(object):
+    ''' A filter of a query plan. Each stage is applied to the positions of
+        the documents that passed the stages before it, which are a list, or
+        a numpy array if the columns are vectorized. '''
+    def __init__(self, name, pattern, selectivity, cost):
+        self.name = name
+        self.pattern = pattern
+        # Estimated fraction of the documents that pass, and cost per
+        # document tested.
+        self.selectivity = selectivity
+        self.cost = cost
+
+        self.count_in = 0
+        self.count_out = 0
+        self.seconds = 0
+
+    def rank(self):
+        ''' Conjunctive filters that are independent are best evaluated in
+            increasing order of their cost per document eliminated. '''
+        if self.selectivity >= 1:
+            return float('inf')
+        return self.cost / (1 - self.selectivity)
+
+
+class _CodeStage(_Stage):
+    ''' Filter on an interned column, passing the documents whose value has
+        one of a set of codes. Its selectivity is known exactly from the
+        column's histogram. '''
+    def __init__(self, name, pattern, column, codes, size):
+        selectivity = column.count(codes) / size if size else 0
+        super().__init__(name, pattern, selectivity, VECTOR_COST)
+        self.column = column
+        self.codes = codes
+
+    def apply(self, positions):
+        column_codes = self.column.codes
+        if isinstance(positions, list):
+            codes = set(self.codes)
+            return [i for i in positions if column_codes[i] in codes]
+        import numpy as np
+        return positions[np.isin(column_codes[positions], self.codes)]
+
+
+class _TagStage(_Stage):
+    ''' Filter on the tags of the documents. Tags are assumed to be
+        independent when estimating the selectivity of several. '''
+    def __init__(self, columns, tags):
+        selectivity = 1.0
+        for tag in tags:
+            selectivity *= (columns.tag_count(tag) / len(columns)
+                            if len(columns) else 0)
+        super().__init__('tags', ','.join(tags), selectivity,
+                         VECTOR_COST * len(tags))
+        self.columns = columns
+        self.tag_list = tags
+
+    def apply(self, positions):
+        for tag in self.tag_list:
+            tagged = self.columns.tags.get(tag)
+            if tagged is None:
+                return positions[:0]
+            if isinstance(positions, list):
+                positions = [i for i in positions if i in tagged]
+            else:
+                positions = positions[tagged[positions]]
+        return positions
+
+
+class _RegexStage(_Stage):
+    ''' Filter on a regex search of a text column. The selectivity and cost
+        are estimated from an evenly spaced sample of the documents. '''
+    def __init__(self, name, regex, values):
+        sample = values[::max(1, len(values) // SAMPLE_SIZE)]
+        hits = sum(1 for value in sample if regex.search(value))
+        # Smoothed, so that a regex matching none of the sample isn't
+        # assumed to match nothing at all.
+        selectivity = (hits + 0.5) / (len(sample) + 1)
+        length = sum(len(value) for value in sample) / max(1, len(sample))
+        super().__init__(name, regex.pattern, selectivity,
+                         REGEX_COST + REGEX_CHAR_COST * length)
+        self.regex = regex
+        self.values = values
+
+    def apply(self, positions):
+        regex = self.regex
+        values = self.values
+        if isinstance(positions, list):
+            return [i for i in positions if regex.search(values[i])]
+        import numpy as np
+        passed = [regex.search(values[i]) is not None for i in positions]
+        return positions[np.array(passed, dtype=bool)]
+
+
+class _TextStage(object):
+    ''' The text filter, which is evaluated by QueryPlan.run_text on the
+        documents that passed the other stages rather than applied to
+        positions. It has no estimates, since it is never reordered. '''
+    def __init__(self, regex):
+        self.name = 'text'
+        self.pattern = regex.pattern
+        self.selectivity = None
+
+        self.count_in = 0
+        self.count_out = 0
+        self.seconds = 0
+
+
+def _years_pattern(years):
+    if len(years) == 1:
+        return years[0]
+    return '{}-{}'.format(years[0], years[-1])
+
+
+class QueryPlan(object):
+    ''' Order in which the filters of a template are evaluated over the
+        catalog's columns. Filters are ordered by their estimated selectivity
+        and cost, from statistics of the library: the histograms of the years,
+        entry types, and venues, the tag counts, and samples of the keys,
+        titles, and authors. The text filter, which is by far the most
+        expensive, is always evaluated last, on the documents that pass the
+        others. '''
+    def __init__(self, columns, tmpl):
+        self.columns = columns
+        self.size = len(columns)
+
+        stages = []
+        if tmpl.key_regex:
+            stages.append(_RegexStage('key', tmpl.key_regex, columns.keys))
+        if tmpl.title_regex:
+            stages.append(_RegexStage('title', tmpl.title_regex,
+                                      columns.titles))
+        for regex in tmpl.author_regexes or []:
+            stages.append(_RegexStage('author', regex, columns.authors))
+        if tmpl.years:
+            stages.append(_CodeStage('year', _years_pattern(tmpl.years),
+                                     columns.year,
+                                     columns.year.codes_in(tmpl.years),
+                                     self.size))
+        if tmpl.venue_regex:
+            codes = columns.venue.codes_where(tmpl.venue_regex.search)
+            stages.append(_CodeStage('venue', tmpl.venue_regex.pattern,
+                                     columns.venue, codes, self.size))
+        if tmpl.entrytype_pattern:
+            codes = columns.entrytype.codes_where(
+                    lambda entrytype: tmpl.entrytype_pattern in entrytype)
+            stages.append(_CodeStage('type', tmpl.entrytype_pattern,
+                                     columns.entrytype, codes, self.size))
+        if tmpl.tag_list:
+            stages.append(_TagStage(columns, tmpl.tag_list))
+        self.stages = sorted(stages, key=_Stage.rank)
+
+        self.text_stage = None
+        if tmpl.text_regex:
+            self.text_stage = _TextStage(tmpl.text_regex)
+
+    def run(self):
+        ''' Return the positions of the documents that pass the metadata
+            filters, recording the number of documents each stage
+            eliminated. '''
+        with profiling.phase('catalog filter'):
+            if self.columns.vectorized:
+                import numpy as np
+                positions = np.arange(self.size)
+            else:
+                positions = list(range(self.size))
+            for stage in self.stages:
+                start = time.perf_counter()
+                stage.count_in = len(positions)
+                if len(positions):
+                    positions = stage.apply(positions)
+                stage.count_out = len(positions)
+                stage.seconds = time.perf_counter() - start
+        return positions
+
+    def run_text(self, docs, match):
+        ''' Evaluate the text stage, match, on the documents that passed the
+            metadata filters, and return the list of its results. '''
+        docs = list(docs)
+        start = time.perf_counter()
+        results = list(match(docs))
+        self.text_stage.count_in = len(docs)
+        self.text_stage.count_out = len(results)
+        self.text_stage.seconds = time.perf_counter() - start
+        return results
+
+    def explain(self):
+        ''' Format the stages of the plan as a table. '''
+        tmpl = '{:<3} {:<7} {:<24} {:>8} {:>8} {:>8} {:>10} {:>9}'
+        lines = ['Plan for {} documents:'.format(self.size),
+                 tmpl.format('', 'stage', 'filter', 'estimate', 'in', 'out',
+                             'eliminated', 'seconds')]
+        stages = self.stages + ([self.text_stage] if self.text_stage else [])
+        for i, stage in enumerate(stages):
+            if stage.selectivity is None:
+                estimate = '-'
+            else:
+                estimate = '{:.1%}'.format(stage.selectivity)
+            lines.append(tmpl.format(
+                i + 1, stage.name, stage.pattern, estimate, stage.count_in,
+                stage.count_out, stage.count_in - stage.count_out,
+                '{:.4f}'.format(stage.seconds)))
+        if not stages:
+            lines.append('No filters; every document matches.')
+        return '\n'.join(lines)
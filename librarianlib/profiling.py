@@ -0,0 +1,123 @@
+import functools
+import os
+import sys
+import time
+
+
+# Accumulated [count, seconds, bytes] for each phase. Nothing is recorded
+# unless profiling has been enabled.
+_phases = {}
+_enabled = False
+
+
+class _Phase(object):
+    ''' Context manager that times a phase. '''
+    def __init__(self, name, nbytes):
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start, self.nbytes)
+        return False
+
+
+class _NullPhase(object):
+    ''' Context manager that does nothing, used when profiling is disabled. '''
+    nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+def enabled():
+    return _enabled
+
+
+def env_setting():
+    ''' Read the LIB_PROFILE environment variable. Returns a tuple
+        (profile, stats_path): unset, empty, or 0 turns profiling off, 1
+        prints the summary only, and any other value is also the path to
+        dump cProfile stats to. '''
+    value = os.environ.get('LIB_PROFILE', '')
+    if value in ('', '0'):
+        return False, None
+    if value == '1':
+        return True, None
+    return True, value
+
+
+def phase(name, nbytes=0):
+    ''' Time a phase of a command. Usage:
+            with phase('name') as p:
+                ...
+                p.nbytes = <number of bytes read>
+        Setting nbytes is optional. '''
+    if _enabled:
+        return _Phase(name, nbytes)
+    return _NULL_PHASE
+
+
+def record(name, seconds=0, nbytes=0):
+    ''' Record an occurrence of a phase. '''
+    if not _enabled:
+        return
+    stats = _phases.setdefault(name, [0, 0, 0])
+    stats[0] += 1
+    stats[1] += seconds
+    stats[2] += nbytes
+
+
+def summary(wall_time):
+    ''' Format a table of the recorded phases, from most to least time. '''
+    tmpl = '{:<24} {:>8} {:>10} {:>14}'
+    lines = [tmpl.format('phase', 'count', 'seconds', 'bytes')]
+    phases = sorted(_phases.items(), key=lambda item: item[1][1], reverse=True)
+    for name, (count, seconds, nbytes) in phases:
+        lines.append(tmpl.format(name, count, '{:.4f}'.format(seconds),
+                                 nbytes if nbytes else '-'))
+    lines.append(tmpl.format('total (wall)', '', '{:.4f}'.format(wall_time),
+                             ''))
+    return '\n'.join(lines)
+
+
+def profiled(func, stats_path=None):
+    ''' Wrap a command so that the time spent in each phase is recorded and
+        printed to stderr when it finishes. If stats_path is given, the
+        command is also run under cProfile and the stats are dumped to that
+        path, for use with pstats. '''
+    @functools.wraps(func)
+    def _wrapper(**kwargs):
+        global _enabled
+        _enabled = True
+        _phases.clear()
+
+        profiler = None
+        if stats_path:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        start = time.perf_counter()
+        try:
+            return func(**kwargs)
+        finally:
+            wall_time = time.perf_counter() - start
+            _enabled = False
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(stats_path)
+            print(summary(wall_time), file=sys.stderr)
+            if profiler is not None:
+                print('Wrote profile to {}.'.format(stats_path),
+                      file=sys.stderr)
+    return _wrapper
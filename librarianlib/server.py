@@ -0,0 +1,94 @@
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+
+from .client import is_private, send, socket_path
+from .exceptions import LibraryException
+
+
+class _ClientWriter(io.TextIOBase):
+    ''' Stream that sends everything written to it back to the client. '''
+    def __init__(self, f, tty):
+        self.f = f
+        self.tty = tty
+
+    def write(self, s):
+        send(self.f, output=s)
+        return len(s)
+
+    def isatty(self):
+        return self.tty
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        writer = _ClientWriter(self.wfile, request['isatty'])
+        try:
+            with contextlib.redirect_stdout(writer), \
+                    contextlib.redirect_stderr(writer):
+                try:
+                    status = self.server.handler(request['argv'],
+                                                 request['cwd'])
+                # argparse exits on --help and invalid arguments.
+                except SystemExit as e:
+                    status = e.code if isinstance(e.code, int) else 1
+            send(self.wfile, status=status)
+        # The client has gone away, e.g. due to ctrl-c.
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class LibraryServer(socketserver.UnixStreamServer):
+    ''' Server that runs commands on behalf of clients, so that the library
+        and its indexes stay loaded between commands. Requests are handled
+        one at a time.
+
+        The handler is called with the command line arguments and working
+        directory of the client, and returns the exit status of the command,
+        or None if the command can't be run by the server. '''
+    def __init__(self, handler, path=None):
+        self.handler = handler
+        path = path if path is not None else socket_path()
+
+        # The socket's directory must be private, or another user could
+        # replace the socket.
+        directory = os.path.dirname(path)
+        try:
+            os.mkdir(directory, 0o700)
+        except FileExistsError:
+            pass
+        if not is_private(directory):
+            msg = '{} must be a directory that only you can access.'.format(
+                directory)
+            raise LibraryException(msg)
+
+        # Clean up after a server that didn't shut down properly.
+        if os.path.exists(path):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            with sock:
+                try:
+                    sock.connect(path)
+                    running = True
+                except OSError:
+                    running = False
+            if running:
+                msg = 'A server is already running at {}.'.format(path)
+                raise LibraryException(msg)
+            os.remove(path)
+
+        # Only the user that started the server may talk to it. The socket
+        # is created with these permissions, rather than changed to them
+        # after it is bound.
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, _RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        super().server_close()
+        os.remove(self.server_address)
@@ -0,0 +1,207 @@
+import os
+
+from . import profiling
+from .exceptions import LibraryException
+
+
+# Extension of the cached text file for each compression format. Only one
+# format is written at a time, but any of them can be read, so that a library
+# can be switched from one to another.
+EXTENSIONS = {
+    'none': '',
+    'gzip': '.gz',
+    'lzma': '.xz',
+    'zstd': '.zst',
+}
+
+# Search the text in chunks of this many characters, so that the whole text
+# of a document never needs to be decompressed into memory at once.
+CHUNK_SIZE = 1 << 20
+
+# A match that ends this close to the end of a chunk might continue into the
+# next one, so it is only counted once more of the text has been read. This is
+# also the amount of text before a chunk that is kept for lookbehinds and word
+# boundaries.
+OVERLAP = 1 << 12
+
+_format = 'none'
+
+
+def _zstd():
+    ''' Import a zstd module, preferring the standard library's (Python
+        3.14+). Returns None if zstd isn't available. '''
+    try:
+        from compression import zstd
+        return zstd
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+
+def _module(fmt):
+    ''' The module used to open files of a compression format. '''
+    if fmt == 'gzip':
+        import gzip
+        return gzip
+    if fmt == 'lzma':
+        import lzma
+        return lzma
+    if fmt == 'zstd':
+        return _zstd()
+    return None
+
+
+def _format_of(path):
+    for fmt, ext in EXTENSIONS.items():
+        if ext and path.endswith(ext):
+            return fmt
+    return 'none'
+
+
+def check_format(fmt):
+    ''' Raise an exception if a compression format is unknown or
+        unavailable. '''
+    if fmt not in EXTENSIONS:
+        msg = 'Unknown text compression {}. Choose from {}.'.format(
+            fmt, ', '.join(EXTENSIONS))
+        raise LibraryException(msg)
+    if fmt == 'zstd' and _zstd() is None:
+        raise LibraryException('zstd compression requires the zstandard '
+                               'package.')
+
+
+def configure(fmt):
+    ''' Set the compression format in which text is saved. '''
+    global _format
+    if fmt is None:
+        fmt = 'none'
+    check_format(fmt)
+    _format = fmt
+
+
+def current_format():
+    return _format
+
+
+def find_text(paths):
+    ''' Return the path of a document's cached text, in whichever format it
+        is stored, or None if it has no cached text. '''
+    candidates = [_format] + [fmt for fmt in EXTENSIONS if fmt != _format]
+    for fmt in candidates:
+        path = paths.text_path + EXTENSIONS[fmt]
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def open_text(path):
+    ''' Open a cached text file for reading as text, decompressing it as it is
+        read. '''
+    fmt = _format_of(path)
+    if fmt == 'none':
+        return open(path)
+    module = _module(fmt)
+    if module is None:
+        msg = 'Reading {} requires the zstandard package.'.format(path)
+        raise LibraryException(msg)
+    return module.open(path, 'rt', encoding='utf-8')
+
+
+def read_text(paths):
+    ''' Read the whole of a document's cached text, or return None if it has
+        none. '''
+    path = find_text(paths)
+    if path is None:
+        return None
+    with profiling.phase('text read') as p, open_text(path) as f:
+        text = f.read()
+        p.nbytes = len(text)
+    return text
+
+
+def write_text(paths, text, fmt=None):
+    ''' Save a document's text in the given compression format, which defaults
+        to the configured one. Copies in any other format are removed. '''
+    fmt = fmt if fmt is not None else _format
+    path = paths.text_path + EXTENSIONS[fmt]
+    tmp_path = path + '.tmp'
+
+    module = _module(fmt)
+    if module is None:
+        f = open(tmp_path, 'w')
+    else:
+        f = module.open(tmp_path, 'wt', encoding='utf-8')
+    with profiling.phase('text write', len(text)), f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+    for ext in EXTENSIONS.values():
+        other_path = paths.text_path + ext
+        if other_path != path and os.path.exists(other_path):
+            os.remove(other_path)
+    return path
+
+
+def convert(paths, fmt):
+    ''' Store the cached text of a document in a different compression format.
+        The modification time of the text is preserved, so that the text index
+        does not consider it changed.
+        Returns a tuple (old_size, new_size) in bytes, or None if the document
+        has no cached text or it is already in the format. '''
+    old_path = find_text(paths)
+    if old_path is None or _format_of(old_path) == fmt:
+        return None
+
+    stat = os.stat(old_path)
+    with open_text(old_path) as f:
+        text = f.read()
+    new_path = write_text(paths, text, fmt)
+    os.utime(new_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    return stat.st_size, os.path.getsize(new_path)
+
+
+def count_matches(regex, path):
+    ''' Count the matches of a regex in a cached text file, as findall would
+        on the whole text, while only holding a chunk of the text in memory.
+        Matches longer than OVERLAP characters that span chunks may be
+        missed. '''
+    count = 0
+    with profiling.phase('regex match') as p, open_text(path) as f:
+        buf = ''
+        # Position in buf from which to continue searching.
+        pos = 0
+        # Whether the last counted match was empty and ended at pos.
+        empty_at_pos = False
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            p.nbytes += len(chunk)
+            eof = not chunk
+            buf += chunk
+
+            limit = len(buf) if eof else len(buf) - OVERLAP
+            # Where to continue from with the next chunk. No match starts
+            # before this unless it would be longer than OVERLAP.
+            resume = max(pos, limit)
+            for match in regex.finditer(buf, pos):
+                if not eof and match.end() > limit:
+                    resume = match.start()
+                    break
+                if empty_at_pos and match.start() == match.end() == pos:
+                    continue
+                count += 1
+                pos = match.end()
+                empty_at_pos = match.start() == match.end()
+                resume = max(pos, limit)
+
+            if eof:
+                return count
+
+            # Drop the text that has been searched, keeping some context.
+            start = max(0, resume - OVERLAP)
+            buf = buf[start:]
+            empty_at_pos = empty_at_pos and pos == resume
+            pos = resume - start
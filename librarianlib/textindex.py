@@ -0,0 +1,426 @@
+import collections
+import os
+import re
+import sqlite3
+
+from . import fileutils, profiling, textcache, trigrams
+
+
+TEXT_INDEX_FILE_NAME = 'text.db'
+
+# Bump this whenever the schema, tokenization, or trigrams change.
+TEXT_INDEX_VERSION = 5
+
+# Document ids are never reused, so that the trigram posting lists can keep
+# the ids of removed documents (see TextIndex.update).
+TEXT_INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    pdf_mtime INTEGER NOT NULL,
+    text_mtime INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS terms (
+    id INTEGER PRIMARY KEY,
+    term TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term INTEGER NOT NULL,
+    doc INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (term, doc)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_by_doc ON postings (doc);
+CREATE TABLE IF NOT EXISTS trigrams (
+    trigram TEXT NOT NULL,
+    block INTEGER NOT NULL,
+    docs BLOB NOT NULL,
+    PRIMARY KEY (trigram, block)
+) WITHOUT ROWID;
+'''
+
+# The documents containing a trigram are stored in blocks of this many
+# consecutive ids, each a row holding one byte per document: its id's offset
+# within the block. Indexing a document only appends to small rows, and the
+# posting lists take a fraction of the space of a row per trigram and
+# document.
+TRIGRAM_BLOCK_SIZE = 256
+
+TERM_REGEX = re.compile(r'\w+')
+
+# Character classes, escape sequences and repeat counts, which are removed
+# from a regex to leave the words it contains.
+REGEX_SYNTAX = re.compile(r'\[[^\]]*\]|\\.|\{[^}]*\}|\(\?\S')
+
+# Number of occurrences of the word given as parameter ?1 within a term,
+# counted as str.count counts them.
+OCCURRENCES_SQL = \
+    "(length(terms.term) - length(replace(terms.term, ?1, ''))) / length(?1)"
+
+# The postings of the terms containing the word ?1. CROSS JOIN makes SQLite
+# scan the terms and look up their postings, rather than scan every posting
+# and look up its term, which is two orders of magnitude slower.
+WORD_POSTINGS_SQL = '''
+FROM terms CROSS JOIN postings ON postings.term = terms.id
+WHERE instr(terms.term, ?1) > 0
+'''
+
+# BM25 parameters.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def _tokenize(text):
+    ''' Split text into terms, case folded as a case-insensitive regex
+        compares them. '''
+    return TERM_REGEX.findall(trigrams._fold(text))
+
+
+def _plain_word(regex):
+    ''' If the regex is a plain word (i.e. can be answered by the index),
+        return the word case folded; otherwise return None. '''
+    if TERM_REGEX.fullmatch(regex.pattern):
+        return trigrams._fold(regex.pattern)
+    return None
+
+
+def _query_terms(regex):
+    ''' The words in a text regex, e.g. reinforc and learn for
+        reinforc\\w+ learn. '''
+    words = _tokenize(REGEX_SYNTAX.sub(' ', regex.pattern))
+    return sorted(set(word for word in words if len(word) > 1))
+
+
+def _int_array(column):
+    ''' Parse a comma separated column of integers into an array. '''
+    import numpy as np
+    return np.fromstring(column, dtype=np.int64, sep=',')
+
+
+def _signature(paths):
+    ''' Modification times of the PDF and its extracted text, or None if
+        either does not exist. '''
+    text_path = textcache.find_text(paths)
+    if text_path is None:
+        return None
+    try:
+        return (os.stat(paths.pdf_path).st_mtime_ns,
+                os.stat(text_path).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+
+def _count(regex, text):
+    if text is None:
+        return 0
+    with profiling.phase('regex match', len(text)):
+        return len(regex.findall(text))
+
+
+class TextIndex(object):
+    ''' Inverted index of the extracted text of documents in the archive,
+        mapping each term to the documents that contain it and the number of
+        times it occurs in each.
+
+        In read-only mode, the index is opened read-only and documents that
+        aren't indexed are searched without indexing them. An index that is
+        missing or out of date is replaced by an empty one in memory. '''
+    def __init__(self, index_path, read_only=False):
+        self.path = os.path.join(index_path, TEXT_INDEX_FILE_NAME)
+        self.read_only = read_only
+
+        if read_only:
+            self.conn = fileutils.connect_read_only(self.path)
+            if self.conn is None or self._version() != TEXT_INDEX_VERSION:
+                self.conn = sqlite3.connect(':memory:')
+                self._init_schema()
+        else:
+            if not os.path.exists(index_path):
+                os.mkdir(index_path)
+            self.conn = sqlite3.connect(self.path)
+            self._init_schema()
+
+        rows = self.conn.execute('SELECT key, pdf_mtime, text_mtime FROM docs')
+        self.signatures = {row[0]: tuple(row[1:]) for row in rows}
+
+        self.index_path = index_path
+        self._corpus = None
+
+    def corpus(self):
+        ''' Return the corpus of all indexed text, reloading it if it has been
+            rebuilt. '''
+        from .corpus import Corpus
+
+        if self._corpus is None or self._corpus.is_stale():
+            if self._corpus is not None:
+                self._corpus.close()
+            self._corpus = Corpus(self.index_path)
+        return self._corpus
+
+    def build_corpus(self, docs):
+        ''' Rebuild the corpus from the text of the documents that are
+            currently indexed. Returns a tuple (number of documents, size in
+            bytes). '''
+        corpus = self.corpus()
+
+        def _documents():
+            for doc in docs:
+                if self.is_current(doc.key, doc.paths):
+                    text = textcache.read_text(doc.paths)
+                    if text is not None:
+                        yield doc.key, self.signatures[doc.key], text
+
+        size = corpus.build(_documents())
+        return len(corpus.keys), size
+
+    def _version(self):
+        return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def _init_schema(self):
+        ''' Create the tables, discarding an incompatible index. '''
+        if self._version() != TEXT_INDEX_VERSION:
+            # SQLite's own tables, e.g. for AUTOINCREMENT, can't be dropped.
+            tables = self.conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' "
+                    "AND name NOT LIKE 'sqlite\\_%' ESCAPE '\\'")
+            for (table,) in tables.fetchall():
+                self.conn.execute('DROP TABLE {}'.format(table))
+            self.conn.execute(
+                    'PRAGMA user_version = {}'.format(TEXT_INDEX_VERSION))
+        self.conn.executescript(TEXT_INDEX_SCHEMA)
+        self.conn.commit()
+
+    def _term_ids(self, terms):
+        ''' Map terms to their ids, adding any that are new. '''
+        self.conn.executemany('INSERT OR IGNORE INTO terms (term) VALUES (?)',
+                              [(term,) for term in terms])
+        ids = {}
+        terms = list(terms)
+        # Stay below SQLite's limit on the number of query parameters.
+        for i in range(0, len(terms), 500):
+            chunk = terms[i:i+500]
+            query = 'SELECT term, id FROM terms WHERE term IN ({})'.format(
+                    ', '.join('?' * len(chunk)))
+            ids.update(self.conn.execute(query, chunk))
+        return ids
+
+    def is_current(self, key, paths):
+        ''' Returns True if the document's text has been indexed since the PDF
+            and text were last modified. '''
+        signature = self.signatures.get(key)
+        return signature is not None and signature == _signature(paths)
+
+    def remove(self, key):
+        ''' Remove a document from the index. '''
+        row = self.conn.execute('SELECT id FROM docs WHERE key = ?',
+                                (key,)).fetchone()
+        if row is not None:
+            self.conn.execute('DELETE FROM postings WHERE doc = ?', row)
+            self.conn.execute('DELETE FROM docs WHERE id = ?', row)
+        self.signatures.pop(key, None)
+
+    def rename(self, old_key, new_key):
+        ''' Move the indexed text of a document to a new key, e.g. when it is
+            rekeyed. The signature is kept, as renaming the files of the
+            document doesn't change their modification times. '''
+        self.remove(new_key)
+        self.conn.execute('UPDATE docs SET key = ? WHERE key = ?',
+                          (new_key, old_key))
+        signature = self.signatures.pop(old_key, None)
+        if signature is not None:
+            self.signatures[new_key] = signature
+        self.commit()
+
+    def _add_trigrams(self, doc_id, text):
+        ''' Add a document to the posting list of each trigram in its
+            text. '''
+        block, offset = divmod(doc_id, TRIGRAM_BLOCK_SIZE)
+        offset = bytes([offset])
+        doc_trigrams = list(trigrams.text_trigrams(text))
+        blocks = {}
+        for i in range(0, len(doc_trigrams), 500):
+            chunk = doc_trigrams[i:i+500]
+            query = 'SELECT trigram, docs FROM trigrams WHERE block = ? ' \
+                    'AND trigram IN ({})'.format(', '.join('?' * len(chunk)))
+            blocks.update(self.conn.execute(query, [block] + chunk))
+        self.conn.executemany(
+                'INSERT OR REPLACE INTO trigrams VALUES (?, ?, ?)',
+                [(trigram, block, blocks.get(trigram, b'') + offset)
+                 for trigram in doc_trigrams])
+
+    def update(self, key, paths, text):
+        ''' (Re)index the text of a document. The ids of removed documents
+            are left in the trigram posting lists, rather than searched for,
+            as they never match a document again. '''
+        self.remove(key)
+
+        signature = _signature(paths)
+        if signature is None:
+            return
+
+        terms = collections.Counter(_tokenize(text)) if text else {}
+        cursor = self.conn.execute(
+                'INSERT INTO docs (key, pdf_mtime, text_mtime, length) '
+                'VALUES (?, ?, ?, ?)',
+                (key,) + signature + (sum(terms.values()),))
+        doc_id = cursor.lastrowid
+
+        term_ids = self._term_ids(terms.keys())
+        self.conn.executemany(
+                'INSERT INTO postings VALUES (?, ?, ?)',
+                [(term_ids[term], doc_id, tf) for term, tf in terms.items()])
+        if text:
+            self._add_trigrams(doc_id, text)
+        self.signatures[key] = signature
+
+    def commit(self):
+        self.conn.commit()
+
+    def word_counts(self, word):
+        ''' Return a dictionary mapping the key of each indexed document to the
+            number of occurrences of the word in its text. Like a regex
+            search, occurrences within longer terms are counted. '''
+        rows = self.conn.execute(
+                'SELECT postings.doc, sum(postings.tf * {}) {} '
+                'GROUP BY postings.doc'.format(OCCURRENCES_SQL,
+                                               WORD_POSTINGS_SQL), (word,))
+        counts = dict(rows.fetchall())
+        keys = self.conn.execute('SELECT id, key FROM docs')
+        return {key: counts[doc_id] for doc_id, key in keys
+                if doc_id in counts}
+
+    def _trigram_docs(self, query):
+        ''' Evaluate a trigram query, returning the set of ids of the
+            documents that satisfy it. '''
+        if isinstance(query, str):
+            rows = self.conn.execute(
+                    'SELECT block, docs FROM trigrams WHERE trigram = ?',
+                    (query,))
+            docs = set()
+            for block, offsets in rows:
+                start = block * TRIGRAM_BLOCK_SIZE
+                docs.update(start + offset for offset in offsets)
+            return docs
+
+        op, queries = query
+        results = [self._trigram_docs(q) for q in queries]
+        if op == 'or':
+            return set().union(*results)
+        # Start from the rarest trigram so that the intermediate sets are
+        # small.
+        results.sort(key=len)
+        docs = results[0]
+        for result in results[1:]:
+            docs = docs.intersection(result)
+        return docs
+
+    def candidates(self, regex):
+        ''' Return the set of keys of the indexed documents whose text may
+            match a regex, based on the trigrams it requires, or None if any
+            document may match. '''
+        query = trigrams.regex_query(regex)
+        if query is None:
+            return None
+        with profiling.phase('trigram lookup'):
+            ids = self._trigram_docs(query)
+            # This also drops the ids of removed documents.
+            rows = self.conn.execute('SELECT id, key FROM docs')
+            return {key for doc_id, key in rows if doc_id in ids}
+
+    def relevance(self, regex):
+        ''' Score every indexed document by its relevance to the words of a
+            text regex, using BM25. As in a regex search, occurrences of a
+            word within longer terms count towards its frequency.
+            Returns a dictionary mapping keys to scores. '''
+        import numpy as np
+
+        with profiling.phase('relevance'):
+            # Columns are fetched as comma separated strings, which is much
+            # faster than fetching a row at a time.
+            ids, lengths, keys = self.conn.execute(
+                    "SELECT group_concat(id), group_concat(length), "
+                    "group_concat(key, char(10)) FROM "
+                    "(SELECT id, length, key FROM docs ORDER BY id)").fetchone()
+            if ids is None:
+                return {}
+            ids = _int_array(ids)
+            lengths = _int_array(lengths)
+            avg_length = max(lengths.mean(), 1)
+            norms = BM25_K1 * (1 - BM25_B + BM25_B * lengths / avg_length)
+
+            scores = np.zeros(len(ids))
+            for word in _query_terms(regex):
+                tf = np.zeros(len(ids))
+                docs, tfs = self.conn.execute(
+                        'SELECT group_concat(postings.doc), '
+                        'group_concat(postings.tf * {}) {}'.format(
+                            OCCURRENCES_SQL, WORD_POSTINGS_SQL),
+                        (word,)).fetchone()
+                if docs is not None:
+                    # A document appears once for each term containing the
+                    # word.
+                    np.add.at(tf, np.searchsorted(ids, _int_array(docs)),
+                              _int_array(tfs))
+
+                df = np.count_nonzero(tf)
+                if df == 0:
+                    continue
+                idf = np.log(1 + (len(ids) - df + 0.5) / (df + 0.5))
+                scores += idf * tf * (BM25_K1 + 1) / (tf + norms)
+
+        return dict(zip(keys.split('\n'), scores.tolist()))
+
+    def matches(self, tmpl, docs, verify=False):
+        ''' Generate (doc, count) tuples for the documents that match the text
+            pattern of the template. Plain word patterns are answered from the
+            index; other regexes are run over the corpus, if one has been
+            built, or else over each document's text. Documents that have
+            not yet been indexed are indexed along the way, unless in
+            read-only mode. If verify is True, the index is bypassed and every
+            PDF is rehashed. '''
+        word = _plain_word(tmpl.text_regex)
+        with profiling.phase('text index lookup'):
+            counts = self.word_counts(word) if word else None
+
+        # Other regexes need only be run on the indexed documents that contain
+        # the trigrams they require, and are run over the corpus for the
+        # documents whose text it holds.
+        candidates = None
+        corpus_counts = None
+        if counts is None and not verify:
+            candidates = self.candidates(tmpl.text_regex)
+            docs = list(docs)
+            corpus = self.corpus()
+            keys = [doc.key for doc in docs
+                    if corpus.contains(doc.key, self.signatures.get(doc.key))
+                    and (candidates is None or doc.key in candidates)]
+            if keys:
+                corpus_counts = corpus.counts(tmpl.text_regex, keys)
+
+        try:
+            for doc in docs:
+                if not verify and self.is_current(doc.key, doc.paths):
+                    if counts is not None:
+                        count = counts.get(doc.key, 0)
+                    elif candidates is not None and doc.key not in candidates:
+                        count = 0
+                    elif (corpus_counts is not None
+                            and doc.key in corpus_counts):
+                        count = corpus_counts[doc.key]
+                    else:
+                        # Stream the text rather than reading it all in.
+                        count = textcache.count_matches(
+                                tmpl.text_regex,
+                                textcache.find_text(doc.paths))
+                else:
+                    text, _ = doc.text(verify)
+                    if not self.read_only:
+                        with profiling.phase('text index update'):
+                            self.update(doc.key, doc.paths, text)
+                    count = _count(tmpl.text_regex, text)
+
+                if count > 0:
+                    yield doc, count
+        finally:
+            self.commit()
@@ -0,0 +1,202 @@
+# Trigram queries for regexes, in the style of Google Code Search. The text of
+# each document is indexed by the set of three character substrings (trigrams)
+# it contains, and a regex is analyzed to find the trigrams that any text it
+# matches must contain. Only documents containing those trigrams need to be
+# searched with the regex itself.
+#
+# A query is either None (any document may match), a trigram, or a tuple
+# ('and', [queries]) or ('or', [queries]).
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+
+# Limit on the number of alternative strings tracked for a run of literals,
+# e.g. from character classes like [ab][cd].
+MAX_STRINGS = 32
+
+# Character ranges wider than this are not treated as literal alternatives.
+MAX_RANGE = 8
+
+# Fixed repeats up to this count are expanded, e.g. x{3} to xxx.
+MAX_EXPANDED_REPEAT = 4
+
+_REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT}
+if hasattr(sre_parse, 'POSSESSIVE_REPEAT'):
+    _REPEATS.add(sre_parse.POSSESSIVE_REPEAT)
+
+# Characters that a case-insensitive regex matches with an ASCII letter, but
+# whose lower case isn't that letter. The lower case of U+0130 is also the
+# only one longer than a single character.
+_FOLD_TABLE = {0x130: 'i', 0x131: 'i', 0x17f: 's'}
+
+
+def _fold(text):
+    ''' Lower case text one character at a time, as a case-insensitive regex
+        compares it, so that its length is unchanged. '''
+    if not text.isascii():
+        text = text.translate(_FOLD_TABLE)
+    return text.lower()
+
+
+def text_trigrams(text):
+    ''' The set of trigrams in some text. The text is case folded, as text
+        searches are case-insensitive. It contains every trigram that the
+        query for an (ASCII) regex matching the text can require. '''
+    text = _fold(text)
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+def _and(queries):
+    queries = [q for q in queries if q is not None]
+    if not queries:
+        return None
+    if len(queries) == 1:
+        return queries[0]
+    flat = []
+    for q in queries:
+        if isinstance(q, tuple) and q[0] == 'and':
+            flat.extend(q[1])
+        else:
+            flat.append(q)
+    return ('and', flat)
+
+
+def _or(queries):
+    if not queries or any(q is None for q in queries):
+        return None
+    if len(queries) == 1:
+        return queries[0]
+    return ('or', queries)
+
+
+def _strings_query(strings):
+    ''' Query for text containing at least one of the strings. '''
+    queries = []
+    for s in strings:
+        trigrams = {s[i:i+3] for i in range(len(s) - 2)}
+        # A string shorter than three characters tells us nothing.
+        if not trigrams:
+            return None
+        queries.append(_and(sorted(trigrams)))
+    return _or(queries)
+
+
+def _in_chars(items):
+    ''' The characters matched by a character class, or None if it matches
+        too many to be worth tracking. '''
+    chars = set()
+    for op, av in items:
+        if op == sre_parse.LITERAL:
+            chars.add(chr(av).lower())
+        elif op == sre_parse.RANGE and av[1] - av[0] < MAX_RANGE:
+            chars.update(chr(c).lower() for c in range(av[0], av[1] + 1))
+        else:
+            return None
+    return chars
+
+
+class _Sequence(object):
+    ''' Accumulates the query for a sequence of regex items. Consecutive
+        literal items are joined into a run of alternative strings, which is
+        turned into a query when a non-literal item ends it. '''
+    def __init__(self):
+        self.queries = []
+        self.run = {''}
+        # Whether the sequence so far matches exactly the strings in run.
+        self.exact = True
+
+    def flush(self):
+        self.queries.append(_strings_query(self.run))
+        self.run = {''}
+
+    def extend(self, strings):
+        ''' Append one of a set of strings to the run. '''
+        run = {r + s for r in self.run for s in strings}
+        if len(run) <= MAX_STRINGS:
+            self.run = run
+            return
+        self.flush()
+        self.exact = False
+        self.run = set(strings) if len(strings) <= MAX_STRINGS else {''}
+
+    def end_run(self, query=None):
+        ''' End the run with an item that isn't literal, but which must match
+            text satisfying query. '''
+        self.flush()
+        self.queries.append(query)
+        self.exact = False
+
+    def result(self):
+        if self.exact:
+            return _strings_query(self.run), self.run
+        self.flush()
+        return _and(self.queries), None
+
+
+def _analyze(items):
+    ''' Analyze a parsed regex. Returns a tuple (query, exact), where exact is
+        the set of strings matched by the regex if it only matches a few
+        fixed strings, and None otherwise. '''
+    seq = _Sequence()
+    for op, av in items:
+        if op == sre_parse.LITERAL:
+            seq.extend({chr(av).lower()})
+        elif op == sre_parse.IN:
+            chars = _in_chars(av)
+            if chars is None:
+                seq.end_run()
+            else:
+                seq.extend(chars)
+        elif op == sre_parse.AT:
+            # Zero-width assertions (^, $, \b) don't consume any text.
+            pass
+        elif op == sre_parse.SUBPATTERN:
+            query, exact = _analyze(av[-1])
+            if exact is not None:
+                seq.extend(exact)
+            else:
+                seq.end_run(query)
+        elif op == sre_parse.BRANCH:
+            results = [_analyze(alternative) for alternative in av[1]]
+            if all(exact is not None for _, exact in results):
+                seq.extend(set().union(*(exact for _, exact in results)))
+            else:
+                seq.end_run(_or([query for query, _ in results]))
+        elif op in _REPEATS:
+            low, high, sub = av
+            query, exact = _analyze(sub)
+            if low == 0:
+                seq.end_run()
+            elif exact is not None and low == high <= MAX_EXPANDED_REPEAT:
+                for _ in range(low):
+                    seq.extend(exact)
+            elif exact is not None:
+                # The text matched by the first repetition follows the run,
+                # and the last precedes whatever comes next.
+                seq.extend(exact)
+                seq.end_run()
+                seq.run = set(exact)
+            else:
+                seq.end_run(query)
+        else:
+            seq.end_run()
+    return seq.result()
+
+
+def regex_query(regex):
+    ''' Return the trigram query that the text of any document matched by a
+        (case-insensitive) regex satisfies, or None if every document must be
+        searched. '''
+    # Case folding of non-ASCII characters doesn't always agree with the
+    # regex's case-insensitive matching.
+    if not regex.pattern.isascii():
+        return None
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return None
+    query, _ = _analyze(list(parsed))
+    return query
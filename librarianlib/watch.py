@@ -0,0 +1,168 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from .exceptions import LibraryException
+
+
+# Flags from linux/inotify.h.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# Events on the archive directory itself, i.e. documents being added, removed,
+# or renamed.
+ARCHIVE_MASK = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+                | IN_ONLYDIR)
+
+# Events on the files of a document. Files that are written in place are
+# reported when they are closed, rather than on every write.
+DOCUMENT_MASK = (IN_CLOSE_WRITE | IN_ATTRIB | IN_CREATE | IN_DELETE
+                 | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+READ_BUFFER_SIZE = 65536
+
+METADATA_DIR_NAME = '.metadata'
+
+
+class _Inotify(object):
+    ''' Minimal binding of the Linux inotify API. '''
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c') or 'libc.so.6'
+        try:
+            self.libc = ctypes.CDLL(libc_name, use_errno=True)
+            init = self.libc.inotify_init1
+        except (OSError, AttributeError):
+            raise LibraryException('Watching requires inotify, which is only '
+                                   'available on Linux.')
+        self.fd = init(IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask):
+        ''' Watch a path. Returns the watch descriptor, or None if the path
+            doesn't exist (anymore) or isn't a directory. '''
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            return None
+        return wd
+
+    def read(self, timeout=None):
+        ''' Wait up to timeout seconds for events, and return a list of
+            (wd, mask, name) tuples. '''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, READ_BUFFER_SIZE)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset+length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ArchiveWatcher(object):
+    ''' Watches the archive for changes to documents, made by any program.
+        The archive directory, the directory of each document, and their
+        metadata directories are watched. '''
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self.inotify = _Inotify()
+
+        # Map of watch descriptors to the key of the document they belong to,
+        # or None for the archive itself.
+        self.watches = {}
+
+        self._watch(archive_path, ARCHIVE_MASK, None)
+        for key in os.listdir(archive_path):
+            self._watch_document(key)
+
+    def _watch(self, path, mask, key):
+        wd = self.inotify.add_watch(path, mask)
+        if wd is not None:
+            self.watches[wd] = key
+
+    def _watch_document(self, key):
+        key_path = os.path.join(self.archive_path, key)
+        self._watch(key_path, DOCUMENT_MASK, key)
+        self._watch(os.path.join(key_path, METADATA_DIR_NAME), DOCUMENT_MASK,
+                    key)
+
+    def _changed_keys(self, events):
+        ''' Map a list of events to the keys of the documents affected.
+            Returns None if events were lost, in which case any document may
+            have changed. '''
+        keys = set()
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if wd not in self.watches:
+                continue
+
+            key = self.watches[wd]
+            if key is None:
+                # A document directory in the archive.
+                key = name
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_document(key)
+            elif name == METADATA_DIR_NAME and mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch(os.path.join(self.archive_path, key, name),
+                            DOCUMENT_MASK, key)
+            keys.add(key)
+        return keys
+
+    def changes(self, delay=1.0, max_delay=None):
+        ''' Generate the sets of keys of the documents that have changed.
+            Bursts of events, such as a document being copied in or a sync
+            touching many files, are collected until no event has arrived for
+            delay seconds (or at most max_delay seconds, which defaults to ten
+            times the delay) and reported together. None is generated if
+            events were lost and the whole archive should be checked. '''
+        if max_delay is None:
+            max_delay = 10 * delay
+
+        while True:
+            keys = self._changed_keys(self.inotify.read())
+            start = time.monotonic()
+            while keys is not None:
+                remaining = max_delay - (time.monotonic() - start)
+                if remaining <= 0:
+                    break
+                events = self.inotify.read(min(delay, remaining))
+                if not events:
+                    break
+                more = self._changed_keys(events)
+                keys = keys.union(more) if more is not None else None
+
+            if keys is None or keys:
+                yield keys
+
+    def close(self):
+        self.inotify.close()